@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+# Headless benchmark for the render and state code of the entry points.
+# Runs with the SDL dummy video driver and fake GPIO, so it works on any machine and never drives
+# the real relays or LEDs, even on the Pi. For each entry point it reports:
+#   - per-frame times of workflow_engine() plus the display update, for every scene, as percentiles
+#   - idle CPU and wakeups per second of the real main loop
+#
+#   ./benchmark.py                              # all entry points
+#   ./benchmark.py maingpiozero.py -n 500       # one entry point, 500 frames per scene
+#   ./benchmark.py maingpiozero.py --imports    # what importing the entry point costs, by package
+
+import os
+
+# Must be set before pygame and gpiozero are imported.
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.environ["GPIOZERO_PIN_FACTORY"] = "mock"
+
+import argparse
+import collections
+import datetime
+import importlib.util
+import inspect
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+ENTRY_POINTS = ["main.py", "maingpiozero.py", "mainv2.py", "mainpyzerovideothread.py"]
+
+# Both monitors side by side, as on the exhibit.
+SCREEN_SIZE = (3840, 1080)
+
+# Game state for each scene. Entry points without the turn images report those scenes as n/a.
+SCENES = {
+    "sunset": {"SOLAR": 0, "WATER": 0, "WIND": 0},
+    "sunshade": {"SOLAR": 1, "WATER": 0, "WIND": 0},
+    "sunout": {"SOLAR": 2, "WATER": 0, "WIND": 0},
+    "hydro": {"SOLAR": 2, "WATER": 1, "WIND": 0},
+    "wind": {"SOLAR": 2, "WATER": 0, "WIND": 1},
+    "turn-left": {"SOLAR": 2, "WATER": 0, "WIND": 0, "LEFT_STATE_CHANGED": True},
+    "turn-right": {"SOLAR": 2, "WATER": 0, "WIND": 0, "RIGHT_STATE_CHANGED": True},
+}
+
+
+# Stand-in for RPi.GPIO. Inputs read HIGH (sensors pulled up, nothing pressed) and outputs are counted.
+def fake_rpi_gpio():
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM, gpio.IN, gpio.OUT = 11, 1, 0
+    gpio.HIGH, gpio.LOW = 1, 0
+    gpio.PUD_UP, gpio.BOTH, gpio.FALLING, gpio.RISING = 22, 33, 32, 31
+    gpio.writes = 0
+    gpio.levels = {}
+
+    # Takes one pin and level, or lists of them, like the real one.
+    def output(pin, level):
+        gpio.writes += 1
+        if isinstance(pin, list):
+            gpio.levels.update(zip(pin, level))
+        else:
+            gpio.levels[pin] = level
+
+    gpio.setmode = gpio.setwarnings = gpio.cleanup = lambda *args, **kwargs: None
+    gpio.setup = lambda pin, direction, **kwargs: gpio.levels.setdefault(pin, kwargs.get("initial", gpio.HIGH))
+    gpio.add_event_detect = lambda *args, **kwargs: None
+    gpio.output = output
+    gpio.input = lambda pin: gpio.levels.get(pin, gpio.HIGH)
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    return rpi, gpio
+
+
+# Stand-in for the libgpiod v1 bindings used by mainv2.py.
+def fake_gpiod():
+    gpiod = types.ModuleType("gpiod")
+    gpiod.LINE_REQ_DIR_IN, gpiod.LINE_REQ_DIR_OUT, gpiod.LINE_REQ_EV_BOTH_EDGES = 2, 3, 6
+    gpiod.LINE_REQ_FLAG_BIAS_PULL_UP = 32
+    gpiod.writes = 0
+
+    class Line:
+        def __init__(self, offset):
+            self._offset = offset
+            self.value = 1
+            # Never written to, so waiting on it waits for ever, like a line that never changes.
+            self._events, self._event_writer = os.pipe()
+
+        def offset(self):
+            return self._offset
+
+        def request(self, consumer=None, type=None, flags=0, default_vals=None):
+            if default_vals:
+                self.value = default_vals[0]
+
+        def event_get_fd(self):
+            return self._events
+
+        def get_value(self):
+            return self.value
+
+        def set_value(self, value):
+            gpiod.writes += 1
+            self.value = value
+
+    class LineBulk:
+        def __init__(self, lines):
+            self.lines = lines
+
+        def request(self, consumer=None, type=None, flags=0, default_vals=None):
+            for line, value in zip(self.lines, default_vals or []):
+                line.value = value
+
+        def set_values(self, values):
+            gpiod.writes += 1
+            for line, value in zip(self.lines, values):
+                line.value = value
+
+        def to_list(self):
+            return self.lines
+
+        def release(self):
+            pass
+
+    class Chip:
+        def __init__(self, name):
+            self.name = name
+
+        def get_line(self, offset):
+            return Line(offset)
+
+        def get_lines(self, offsets):
+            return LineBulk([Line(offset) for offset in offsets])
+
+    gpiod.Chip = Chip
+    return gpiod
+
+
+# Used when pyvidplayer2 or the movie file is not available, so the rest of the loop can still be measured.
+class StandInVideo:
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        self.active = False
+        self.frame = 0
+        self.quality = "full"
+        self.dropped = 0
+
+    def mute(self):
+        pass
+
+    def play(self):
+        self.active = True
+
+    def restart(self):
+        self.frame = 0
+
+    def stop(self):
+        self.active = False
+
+    def close(self):
+        pass
+
+    def draw(self, surf, pos, force_draw=True):
+        return False
+
+
+HYDRO_MOVIE = "images/howdoeshydropowerwork1080p.mp4"
+
+# The video players the entry points use, the class each plays with and the modules each needs.
+VIDEO_PLAYERS = {
+    "pyvidplayer2": ("Video", ("pyvidplayer2", "cv2")),
+    "videoplayer": ("ThreadedVideo", ("cv2", "numpy")),
+}
+
+
+# Put a stand-in in place of each video player that can't play the movie here.
+def install_stand_in_video(movie_path=HYDRO_MOVIE):
+    for player, (class_name, modules) in VIDEO_PLAYERS.items():
+        if not real_video_available(movie_path, modules):
+            stand_in = types.ModuleType(player)
+            setattr(stand_in, class_name, StandInVideo)
+            sys.modules[player] = stand_in
+
+
+def install_fakes():
+    install_stand_in_video()
+    rpi, gpio = fake_rpi_gpio()
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    sys.modules["gpiod"] = fake_gpiod()
+    try:
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+
+        # A fresh factory for each entry point, as they all claim the same pins.
+        Device.pin_factory = MockFactory()
+    except ImportError:
+        pass
+
+
+def real_video_available(movie_path, modules=("pyvidplayer2", "cv2")):
+    if not os.path.exists(movie_path):
+        return False
+    return all(module_available(name) for name in modules)
+
+
+# The stand-ins put in sys.modules by an earlier entry point have no spec, and find_spec raises on them.
+def module_available(name):
+    if name in sys.modules:
+        return sys.modules[name].__spec__ is not None
+    return importlib.util.find_spec(name) is not None
+
+
+def import_entry_point(path):
+    install_fakes()
+    name = "bench_" + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if hasattr(module, "load_sounds"):
+        module.load_sounds = with_silent_sounds(module.load_sounds)
+    return module
+
+
+# The sound files are not in the repo. Fill in silent sounds for any that fail to load.
+def with_silent_sounds(load_sounds):
+    def load_sounds_or_silence(*args, **kwargs):
+        loaded_sounds = load_sounds(*args, **kwargs)
+        if not pygame.mixer.get_init():
+            pygame.mixer.init()
+        for name in ("hydro", "wind", "night", "owl"):
+            if name not in loaded_sounds:
+                loaded_sounds[name] = pygame.mixer.Sound(buffer=bytes(4096))
+        return loaded_sounds
+
+    return load_sounds_or_silence
+
+
+def load_module_assets(module):
+    module.pygame_screen = pygame.display.set_mode(SCREEN_SIZE, pygame.NOFRAME)
+    if hasattr(module, "setup_gpio"):
+        module.setup_gpio()
+    if hasattr(module, "load_images"):
+        if module.load_images.__code__.co_argcount:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                loaded = module.load_images(executor)
+        else:
+            loaded = module.load_images()
+        if isinstance(loaded, tuple):
+            module.pygame_images, module.pygame_scenes = loaded
+        else:
+            module.pygame_images = loaded
+            # Entry points that load the images on their own leave composing the scenes to main().
+            if hasattr(module, "compose_scenes"):
+                module.pygame_scenes = module.compose_scenes(loaded)
+    module.pygame_sounds = module.load_sounds() if hasattr(module, "load_sounds") else {}
+    module.pygame_movie = StandInVideo(HYDRO_MOVIE)
+
+
+def set_scene(module, state):
+    for flag in ("LEFT_STATE_CHANGED", "RIGHT_STATE_CHANGED"):
+        if hasattr(module, flag):
+            setattr(module, flag, False)
+    for name, value in state.items():
+        setattr(module, name, value)
+    # Keep the motors inside their run window for the whole measurement. Entry points that time the
+    # motors on the monotonic clock start with a float there.
+    if isinstance(getattr(module, "water_started", None), float):
+        module.water_started = module.wind_started = time.monotonic()
+    else:
+        module.water_started = module.wind_started = datetime.datetime.now()
+
+
+# One frame as the main loops do it: run the workflow, then push whatever changed to the display.
+def run_frame(module):
+    module.workflow_engine()
+    dirty_rects = getattr(module, "dirty_rects", None)
+    if dirty_rects:
+        pygame.display.update(dirty_rects)
+        dirty_rects.clear()
+
+
+def percentiles(samples):
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98], "max": max(samples)}
+
+
+def time_frames(module, frames, next_scene):
+    wall, cpu = [], []
+    for frame in range(frames):
+        next_scene(frame)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        run_frame(module)
+        wall.append((time.perf_counter() - wall_start) * 1000)
+        cpu.append((time.process_time() - cpu_start) * 1000)
+    return wall, cpu
+
+
+def benchmark_scenes(module, frames):
+    results = {}
+    for scene, state in SCENES.items():
+        if not all(hasattr(module, name) for name in state):
+            results[scene] = None
+            continue
+        # Steady state: the same scene frame after frame, like the exhibit sitting idle.
+        results[scene] = time_frames(module, frames, lambda frame: set_scene(module, state))
+    # Worst case: the scene changes on every frame.
+    states = [state for scene, state in SCENES.items() if results[scene] is not None]
+    results["cycle"] = time_frames(module, frames, lambda frame: set_scene(module, states[frame % len(states)]))
+    return results
+
+
+# The calls the main loops block in. Each return from one of these on the main thread is a wakeup.
+BLOCKING_CALLS = [(time, "sleep"), (pygame.time, "wait"), (pygame.event, "wait")]
+
+
+# Run the entry point's real main() for a few seconds and measure its CPU use once the loop is running.
+def benchmark_main_loop(module, seconds):
+    loop = {"wakeups": 0}
+    originals = [(owner, name, getattr(owner, name)) for owner, name in BLOCKING_CALLS]
+    workflow_engine = module.workflow_engine
+
+    def counting(blocking_call):
+        def counted_call(*args, **kwargs):
+            if threading.current_thread() is threading.main_thread():
+                loop["wakeups"] += 1
+            return blocking_call(*args, **kwargs)
+
+        return counted_call
+
+    def timed_workflow_engine():
+        if "started" not in loop:
+            loop["started"] = (time.perf_counter(), time.process_time(), loop["wakeups"])
+            threading.Timer(seconds, pygame.event.post, [pygame.event.Event(pygame.QUIT)]).start()
+        workflow_engine()
+
+    for owner, name, blocking_call in originals:
+        setattr(owner, name, counting(blocking_call))
+    module.workflow_engine = timed_workflow_engine
+    try:
+        module.main()
+    except SystemExit:
+        pass
+    finally:
+        for owner, name, blocking_call in originals:
+            setattr(owner, name, blocking_call)
+        module.workflow_engine = workflow_engine
+    if "started" not in loop:
+        raise RuntimeError("main loop never ran")
+    wall_start, cpu_start, wakeups_start = loop["started"]
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return {"cpu": cpu / wall * 100, "wakeups": (loop["wakeups"] - wakeups_start) / wall}
+
+
+def print_results(path, results, main_loop):
+    print(f"\n== {path}")
+    print(f"{'scene':<12}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'cpu ms':>9}")
+    for scene, timings in results.items():
+        if timings is None:
+            print(f"{scene:<12}{'n/a':>9}")
+            continue
+        wall, cpu = timings
+        stats = percentiles(wall)
+        print(
+            f"{scene:<12}{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}"
+            f"{stats['max']:>9.3f}{statistics.mean(cpu):>9.3f}"
+        )
+    if isinstance(main_loop, dict):
+        print(f"main loop: {main_loop['cpu']:.1f}% CPU, {main_loop['wakeups']:.0f} wakeups/s")
+    else:
+        print(f"main loop: {main_loop}")
+
+
+# Run in a fresh interpreter by profile_imports(), after the source of the fake GPIO libraries.
+IMPORT_ENTRY_POINT = """
+rpi, gpio = fake_rpi_gpio()
+sys.modules.update({"RPi": rpi, "RPi.GPIO": gpio, "gpiod": fake_gpiod()})
+spec = importlib.util.spec_from_file_location("entry_point", sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+
+# Import the entry point in a fresh interpreter with -X importtime and sum up what each top level package
+# costs. RPi.GPIO and gpiod are faked so nothing is driven, and gpiozero is imported with its mock pins.
+def profile_imports(path, top=15):
+    code = "\n".join(
+        ["import importlib.util, os, sys, types", inspect.getsource(fake_rpi_gpio), inspect.getsource(fake_gpiod)]
+    )
+    child = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code + IMPORT_ENTRY_POINT, path],
+        capture_output=True,
+        text=True,
+    )
+    if child.returncode != 0:
+        errors = [line for line in child.stderr.splitlines() if not line.startswith("import time:")]
+        print(f"\n== {path}\nimport failed: {errors[-1]}")
+        return
+    packages = collections.Counter()
+    modules = collections.Counter()
+    for line in child.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(own_us)
+        # Top level imports aren't indented, and their cumulative time covers everything they import.
+        if not name.startswith("  "):
+            packages[name.strip().split(".")[0]] += int(cumulative_us)
+    print(f"\n== {path} imports, {sum(packages.values()) / 1000:.0f} ms in total")
+    print(f"{'package':<32}{'ms':>9}")
+    for name, us in packages.most_common(top):
+        print(f"{name:<32}{us / 1000:>9.1f}")
+    print(f"{'slowest modules by own time':<32}{'ms':>9}")
+    for name, us in modules.most_common(top):
+        print(f"{name:<32}{us / 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless frame-time benchmark for the entry points")
+    parser.add_argument("entry_points", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("-n", "--frames", type=int, default=200, help="frames measured per scene")
+    parser.add_argument("-s", "--seconds", type=float, default=3, help="how long to run each main loop")
+    parser.add_argument("--imports", action="store_true", help="report import times instead of frame times")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.imports:
+        for path in args.entry_points:
+            profile_imports(path)
+        return
+    for player, (class_name, modules) in VIDEO_PLAYERS.items():
+        if not real_video_available(HYDRO_MOVIE, modules):
+            print(f"{', '.join(modules)} or the hydro movie is missing, using a stand-in for {player}")
+    for path in args.entry_points:
+        try:
+            module = import_entry_point(path)
+            pygame.init()
+            load_module_assets(module)
+            results = benchmark_scenes(module, args.frames)
+        except Exception as e:
+            print(f"\n== {path}\nfailed: {type(e).__name__}: {e}")
+            continue
+        try:
+            main_loop = benchmark_main_loop(module, args.seconds)
+        except Exception as e:
+            main_loop = f"failed: {type(e).__name__}: {e}"
+        print_results(path, results, main_loop)
+
+
+if __name__ == "__main__":
+    main()
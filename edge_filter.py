@@ -0,0 +1,81 @@
+# Debouncing and glitch filtering for the exhibit's inputs, worked out from the time each edge happened
+# (the kernel's timestamp where the GPIO library passes it on) rather than when it was noticed.
+#
+# A change of level is only passed on once:
+#   - the new level has held for the rule's stable time,
+#   - at least hysteresis seconds have gone by since the last change passed on, so a sensor on the edge
+#     of two states can't flap the exhibit back and forth,
+#   - and the pin has read back at the new level samples times in a row, SAMPLE_INTERVAL apart.
+# Edges that are undone before then are bounces, counted and dropped.
+#
+# The filter does no waiting itself. After each edge or check, due_time() says when to check it next.
+# Times are seconds on time.monotonic().
+
+import collections
+
+# stable and hysteresis in seconds, samples is how many reads in a row must agree.
+EdgeRule = collections.namedtuple("EdgeRule", ["stable", "hysteresis", "samples"])
+
+SAMPLE_INTERVAL = 0.005
+
+
+class EdgeFilter:
+    def __init__(self, rule, level, now):
+        self.rule = rule
+        # The level passed on, and when it changed.
+        self.level = level
+        self.changed_at = now - rule.hysteresis
+        # The last level seen on the pin, when its edge happened, and what came with the edge.
+        self.pending = level
+        self.pending_since = now
+        self.pending_data = None
+        self.samples = 0
+        self.last_check = 0.0
+        self.edges = 0
+        self.accepted = 0
+
+    @property
+    def bounces(self):
+        return self.edges - self.accepted
+
+    def edge(self, edge_time, level, data=None):
+        if level == self.pending:
+            return
+        self.edges += 1
+        self.pending = level
+        self.pending_since = edge_time
+        self.pending_data = data
+        self.samples = 0
+
+    # When to call check() next, or None if the pin is at the level already passed on.
+    def due_time(self):
+        if self.pending == self.level:
+            return None
+        return max(
+            self.pending_since + self.rule.stable,
+            self.changed_at + self.rule.hysteresis,
+            self.last_check + SAMPLE_INTERVAL,
+        )
+
+    # Check a pending change against the level read from the pin now. Returns True when the change
+    # is accepted, and self.level is the new level.
+    def check(self, now, level_read):
+        if self.pending == self.level or now < self.due_time():
+            return False
+        self.last_check = now
+        if level_read != self.pending:
+            self.samples = 0
+            if level_read == self.level:
+                # The pin went back and that edge was lost. Drop the change as a bounce, or it
+                # would be checked again every SAMPLE_INTERVAL for good.
+                self.edges += 1
+                self.pending = self.level
+            # Otherwise the pin has moved again and that edge hasn't been seen yet.
+            return False
+        self.samples += 1
+        if self.samples < self.rule.samples:
+            return False
+        self.level = self.pending
+        self.changed_at = now
+        self.accepted += 1
+        return True
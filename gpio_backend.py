@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# One interface for driving the exhibit's outputs (house LEDs and motor relays) over any of the three
+# GPIO libraries the entry points use, so the same workflow code runs on each of them.
+#
+#   outputs = open_outputs({"house1": 1, "water": 2}, initial={"water": 1}, default_backend="gpiozero")
+#   outputs.write({"house1": 1, "water": 0})
+#
+# write() sets all the given outputs in one go. With gpiod that is a single bulk request on the chip,
+# so every line changes at the same instant for one syscall. RPi.GPIO takes them as one call.
+# gpiozero has no bulk write and sets them one at a time.
+#
+# The backend can be chosen with the GPIO_BACKEND environment variable: gpiod, rpigpio or gpiozero.
+# Levels are raw pin levels, 1 is high and 0 is low.
+#
+# Every backend keeps a shadow copy of the levels it has set, and write() only touches the pins whose
+# level actually changes. written and skipped count the pin writes done and avoided.
+#
+# GpiodInputs requests input lines for edge events, so a script can sleep in select or poll on their
+# file descriptors until something changes instead of reading the levels over and over.
+
+import os
+
+GPIOD_CHIP = "gpiochip0"
+
+# The house LED outputs, in the order they light up.
+HOUSES = ("house1", "house2", "house3", "house4")
+
+
+# Levels for the house LEDs with the first lit houses on.
+def house_lights(lit):
+    return {house: int(number < lit) for number, house in enumerate(HOUSES)}
+
+
+class Outputs:
+    def __init__(self, pins, initial):
+        self.pins = pins
+        self.levels = dict(initial)
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, levels):
+        changed = {name: level for name, level in levels.items() if self.levels[name] != level}
+        self.skipped += len(levels) - len(changed)
+        if not changed:
+            return
+        self.written += len(changed)
+        self.levels.update(changed)
+        self._set(changed)
+
+
+class GpiodOutputs(Outputs):
+    def __init__(self, pins, initial):
+        import gpiod
+
+        super().__init__(pins, initial)
+        self._gpiod = gpiod
+        offsets = list(pins.values())
+        if hasattr(gpiod, "request_lines"):
+            # libgpiod v2
+            from gpiod.line import Direction, Value
+
+            self._values = {0: Value.INACTIVE, 1: Value.ACTIVE}
+            self._request = gpiod.request_lines(
+                "/dev/" + GPIOD_CHIP,
+                consumer="sustainability",
+                config={tuple(offsets): gpiod.LineSettings(direction=Direction.OUTPUT)},
+                output_values={pins[name]: self._values[level] for name, level in self.levels.items()},
+            )
+        else:
+            # libgpiod v1. A bulk request always sets every line, so the current levels are kept.
+            self._request = gpiod.Chip(GPIOD_CHIP).get_lines(offsets)
+            self._request.request(
+                consumer="sustainability",
+                type=gpiod.LINE_REQ_DIR_OUT,
+                default_vals=[self.levels[name] for name in pins],
+            )
+
+    def _set(self, levels):
+        if hasattr(self._gpiod, "request_lines"):
+            self._request.set_values({self.pins[name]: self._values[level] for name, level in levels.items()})
+        else:
+            self._request.set_values([self.levels[name] for name in self.pins])
+
+    def close(self):
+        self._request.release()
+
+
+# Pull-up inputs with edge detection on both edges. filenos() are the descriptors to wait on,
+# read_edges() returns the edges waiting on one of them as (name, level, seconds), timestamped by the
+# kernel on the monotonic clock.
+class GpiodInputs:
+    def __init__(self, pins):
+        import gpiod
+
+        self.pins = pins
+        self._gpiod = gpiod
+        self._names = {pin: name for name, pin in pins.items()}
+        offsets = list(pins.values())
+        if hasattr(gpiod, "request_lines"):
+            # libgpiod v2, one request and one descriptor for all the lines.
+            from gpiod.line import Bias, Direction, Edge, Value
+
+            self._active = Value.ACTIVE
+            self._request = gpiod.request_lines(
+                "/dev/" + GPIOD_CHIP,
+                consumer="sustainability",
+                config={
+                    tuple(offsets): gpiod.LineSettings(
+                        direction=Direction.INPUT, edge_detection=Edge.BOTH, bias=Bias.PULL_UP
+                    )
+                },
+            )
+            self._lines = {self._request.fd: None}
+        else:
+            # libgpiod v1, a descriptor for each line.
+            self._request = gpiod.Chip(GPIOD_CHIP).get_lines(offsets)
+            self._request.request(
+                consumer="sustainability",
+                type=gpiod.LINE_REQ_EV_BOTH_EDGES,
+                flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP,
+            )
+            self._by_name = {self._names[line.offset()]: line for line in self._request.to_list()}
+            self._lines = {line.event_get_fd(): line for line in self._by_name.values()}
+
+    def filenos(self):
+        return list(self._lines)
+
+    def read_edges(self, fd):
+        line = self._lines[fd]
+        if line is None:
+            rising = self._gpiod.EdgeEvent.Type.RISING_EDGE
+            return [
+                (self._names[event.line_offset], int(event.event_type == rising), event.timestamp_ns / 1e9)
+                for event in self._request.read_edge_events()
+            ]
+        event = line.event_read()
+        name = self._names[line.offset()]
+        return [(name, int(event.type == self._gpiod.LineEvent.RISING_EDGE), event.sec + event.nsec / 1e9)]
+
+    def level(self, name):
+        if hasattr(self._gpiod, "request_lines"):
+            return int(self._request.get_value(self.pins[name]) == self._active)
+        return self._by_name[name].get_value()
+
+    def close(self):
+        self._request.release()
+
+
+class RPiGPIOOutputs(Outputs):
+    def __init__(self, pins, initial):
+        import RPi.GPIO as GPIO
+
+        super().__init__(pins, initial)
+        self._gpio = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        for name, pin in pins.items():
+            GPIO.setup(pin, GPIO.OUT, initial=self.levels[name])
+
+    def _set(self, levels):
+        self._gpio.output([self.pins[name] for name in levels], list(levels.values()))
+
+    def close(self):
+        self._gpio.cleanup(list(self.pins.values()))
+
+
+class GpiozeroOutputs(Outputs):
+    def __init__(self, pins, initial):
+        from gpiozero import DigitalOutputDevice
+
+        super().__init__(pins, initial)
+        self._devices = {
+            name: DigitalOutputDevice(pin, initial_value=bool(self.levels[name])) for name, pin in pins.items()
+        }
+
+    def _set(self, levels):
+        for name, level in levels.items():
+            self._devices[name].value = level
+
+    def close(self):
+        for device in self._devices.values():
+            device.close()
+
+
+BACKENDS = {
+    "gpiod": GpiodOutputs,
+    "rpigpio": RPiGPIOOutputs,
+    "gpiozero": GpiozeroOutputs,
+}
+
+
+# pins maps output names to BCM pin numbers. Outputs not in initial start low.
+def open_outputs(pins, initial=None, default_backend="gpiozero"):
+    backend = os.environ.get("GPIO_BACKEND", default_backend)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown GPIO_BACKEND {backend}, expected one of {', '.join(BACKENDS)}")
+    levels = {name: 0 for name in pins}
+    levels.update(initial or {})
+    print(f"Driving outputs with {backend}")
+    return BACKENDS[backend](pins, levels)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Record the exhibit's input edges to a trace file, and replay a trace into a headless run of it.
+#
+# Recording: run the exhibit with GPIO_RECORD set to a file, and every edge on the input pins is written
+# with its monotonic time, pin and level, 10 bytes an edge:
+#   GPIO_RECORD=/home/pi/holidays.trace ./maingpiozero.py
+#
+# Replaying: runs the exhibit with fake pins driven from the trace, at its own pace or sped up, then
+# reports the CPU used and how long each edge took to reach the screen:
+#   ./gpio_trace.py replay /home/pi/holidays.trace --speed 100
+#
+# An edge reaches the screen with the first display update after the GPIO action it set off changes the
+# exhibit's state, or when the workflow engine has run if the change draws nothing. Edges dropped by the
+# filters, and actions that leave the state as it was (presses while a motor runs), count as having had
+# no effect. State changes made by the motor timers are not timed.
+#
+# The edge filters run on the trace's clock, so they pass and drop the same edges as on the day. The motor
+# timers and the video still run in real time though, so a sped up replay packs the presses closer
+# together than they ever happened. That makes it a load test rather than a rerun of the day.
+
+import argparse
+import os
+import statistics
+import struct
+import sys
+import threading
+import time
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+# Sunset and sun behind clouds, the hydro and wind buttons, and the left and right stop sensors.
+INPUT_PINS = (19, 20, 21, 26, 12, 16)
+
+TRACE_MAGIC = b"GPT1"
+TRACE_EDGE = struct.Struct("<dBB")  # Seconds since the recording started, pin, level.
+
+
+class TraceRecorder:
+    def __init__(self, trace_path, pin_numbers):
+        self._file = open(trace_path, "wb")
+        self._file.write(TRACE_MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        # Pins only hold a weak reference to their handler, so keep the handlers alive here.
+        self._handlers = []
+        for pin_number in pin_numbers:
+            pin = Device.pin_factory.pin(pin_number)
+            self.write(pin_number, pin.state)
+            self._attach(pin, pin_number)
+
+    def _attach(self, pin, pin_number):
+        device_handler = pin.when_changed
+
+        def record_edge(ticks, state):
+            self.write(pin_number, state)
+            if device_handler is not None:
+                device_handler(ticks, state)
+
+        self._handlers.append(record_edge)
+        pin.when_changed = record_edge
+
+    def write(self, pin_number, state):
+        with self._lock:
+            if self._file.closed:
+                # An edge while the exhibit shuts down.
+                return
+            self._file.write(TRACE_EDGE.pack(time.monotonic() - self._start, pin_number, int(state)))
+            # Edges are rare, and the recording should survive the power being pulled.
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(trace_path):
+    with open(trace_path, "rb") as trace_file:
+        data = trace_file.read()
+    if data[: len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError(f"{trace_path} is not a GPIO trace")
+    edges = data[len(TRACE_MAGIC) :]
+    # A recording cut off mid write ends with a partial edge.
+    edges = edges[: len(edges) - len(edges) % TRACE_EDGE.size]
+    return list(TRACE_EDGE.iter_unpack(edges))
+
+
+# Mock pins that are driven from a trace once start() is called. on_edge is called after each edge is
+# driven, and on_finished once the whole trace has been played.
+class ReplayFactory(MockFactory):
+    def __init__(self, trace_path, speed=1.0, on_edge=None, on_finished=None):
+        super().__init__()
+        self.edges = read_trace(trace_path)
+        self.speed = speed
+        self.on_edge = on_edge
+        self.on_finished = on_finished
+        self.late = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._replay, name="gpio replay", daemon=True)
+            self._thread.start()
+
+    def _replay(self):
+        start = time.monotonic()
+        for seconds, pin_number, state in self.edges:
+            due = start + seconds / self.speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.late.append(max(0.0, -wait))
+            pin = self.pin(pin_number)
+            if state:
+                pin.drive_high()
+            else:
+                pin.drive_low()
+            if self.on_edge is not None:
+                self.on_edge(pin_number, state)
+        if self.on_finished is not None:
+            self.on_finished()
+
+
+# Called by the exhibit once its input callbacks are set up. Records if GPIO_RECORD is set, and starts
+# the replay if the pins come from a trace. Returns the recorder, if there is one, to close on exit.
+def start_trace(pin_numbers=INPUT_PINS):
+    if isinstance(Device.pin_factory, ReplayFactory):
+        Device.pin_factory.start()
+    if os.environ.get("GPIO_RECORD"):
+        print(f"Recording input edges to {os.environ['GPIO_RECORD']}")
+        return TraceRecorder(os.environ["GPIO_RECORD"], pin_numbers)
+    return None
+
+
+def milliseconds(samples):
+    if len(samples) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return f"p50 {cuts[49] * 1000:.1f} ms, p95 {cuts[94] * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms"
+
+
+# The globals the entry points keep their state in.
+STATE_NAMES = ("SOLAR", "WATER", "WIND", "LEFT_STATE_CHANGED", "RIGHT_STATE_CHANGED")
+
+# How long after the last edge's filters have settled to wait for the main loop to show it.
+REPLAY_SETTLE_SECONDS = 0.2
+
+
+def replay(trace_path, speed, script):
+    # Load the script the way the benchmark does: headless, with its stand-ins for the movie and the
+    # sounds when they aren't there, as they aren't off the exhibit.
+    import benchmark
+    import pygame
+    from edge_filter import SAMPLE_INTERVAL
+
+    module = benchmark.import_entry_point(script)
+
+    # The edge times of GPIO actions that changed the state, waiting for the display update that shows
+    # the change, and the time from each of those edges to that update.
+    changed = []
+    to_screen = []
+    update = pygame.display.update
+
+    def reached_screen():
+        now = time.monotonic()
+        to_screen.extend(now - edge_time for edge_time in changed)
+        changed.clear()
+
+    def timed_update(*args):
+        result = update(*args)
+        reached_screen()
+        return result
+
+    def state():
+        return tuple(getattr(module, name, None) for name in STATE_NAMES)
+
+    # Only the GPIO actions are timed, state changes made by the motor timers are left out.
+    run_gpio_event = module.run_gpio_event
+
+    def timed_run_gpio_event(edge_time, callback, record_latency):
+        before = state()
+        run_gpio_event(edge_time, callback, record_latency)
+        if state() != before:
+            changed.append(edge_time)
+
+    workflow_engine = module.workflow_engine
+
+    def timed_workflow_engine():
+        workflow_engine()
+        if not module.dirty_rects:
+            # The change didn't touch the screen, so there is no update to wait for.
+            reached_screen()
+
+    # Give the last edges time to get through their filters and reach the screen before quitting.
+    def finish():
+        rules = [edge_filter.rule for edge_filter, on_edge in getattr(module, "edge_filters", {}).values()]
+        settle = max((rule.stable + rule.hysteresis + rule.samples * SAMPLE_INTERVAL for rule in rules), default=0.0)
+        quit_event = pygame.event.Event(pygame.QUIT)
+        threading.Timer(settle / speed + REPLAY_SETTLE_SECONDS, pygame.event.post, [quit_event]).start()
+
+    module.run_gpio_event = timed_run_gpio_event
+    module.workflow_engine = timed_workflow_engine
+    pygame.display.update = timed_update
+    factory = ReplayFactory(trace_path, speed, on_finished=finish)
+    Device.pin_factory = factory
+    # The script imports this file as gpio_trace, make that this module so it recognises the factory.
+    sys.modules["gpio_trace"] = sys.modules[__name__]
+    print(f"Replaying {len(factory.edges)} edges from {trace_path} at {speed}x into {script}")
+    wall_start, cpu_start = time.monotonic(), time.process_time()
+    try:
+        module.main()
+    except SystemExit:
+        pass
+    wall, cpu = time.monotonic() - wall_start, time.process_time() - cpu_start
+    print(f"{wall:.1f} s, {cpu:.1f} s CPU ({cpu / wall:.0%})")
+    print(f"Edge to screen: {milliseconds(to_screen)} ({len(to_screen)} edges changed the state, "
+          f"{len(factory.edges) - len(to_screen)} did not)")
+    print(f"Replay lateness: {milliseconds(factory.late)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded GPIO trace into the exhibit.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subcommands.add_parser("replay", help="replay a trace into a headless run")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="1 for real time, 100 for 100x")
+    replay_parser.add_argument("--script", default="maingpiozero.py")
+    show_parser = subcommands.add_parser("show", help="print the edges in a trace")
+    show_parser.add_argument("trace")
+    args = parser.parse_args()
+    if args.command == "replay":
+        replay(args.trace, args.speed, args.script)
+    else:
+        for seconds, pin_number, state in read_trace(args.trace):
+            print(f"{seconds:12.6f}  GPIO{pin_number:<2}  {'high' if state else 'low'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,7 @@
 import RPi.GPIO as GPIO
 import time
 import datetime
+import math
 import subprocess
 
 import sys
@@ -32,8 +33,12 @@ import os
 import pygame
 from pygame.locals import *
 
-# Pygame movie module
-from pyvidplayer2 import Video
+# Plays the movies with decoding on a thread of its own
+from videoplayer import ThreadedVideo
+
+# House LEDs and motor relays
+from gpio_backend import house_lights, open_outputs
+from scenes import compose_scenes, convert_image
 
 
 PI_HIGH = 1
@@ -60,9 +65,40 @@ HOUSE4_GPIO = 25
 WATER_GPIO = 2
 WIND_GPIO = 3
 
+# GPIO 1,7,8,25 are outputs for the LEDS on the houses, and the Relay for Motors GPIO Pins are set to HIGH.
+# All of them are written together in one call.
+OUTPUTS = open_outputs(
+    {
+        "house1": HOUSE1_GPIO,
+        "house2": HOUSE2_GPIO,
+        "house3": HOUSE3_GPIO,
+        "house4": HOUSE4_GPIO,
+        "water": WATER_GPIO,
+        "wind": WIND_GPIO,
+    },
+    initial={"water": PI_HIGH, "wind": PI_HIGH},
+    default_backend="rpigpio",
+)
+
 # Has STATE Changed?
 STATE_CHANGED = False
 
+# Screen layout. The left monitor shows the video, the right monitor shows the scenes.
+LEFT_SCREEN_RECT = pygame.Rect(0, 0, 1920, 1080)
+RIGHT_SCREEN_POS = (1921, 0)
+
+# The scene currently on the right screen, so we only redraw it when it changes.
+last_scene = None
+
+# Posted by the GPIO callbacks to wake the main loop.
+GPIO_EVENT = pygame.event.custom_type()
+# How often the loop wakes to draw the video while it plays.
+VIDEO_WAKE_MS = 10
+# Frames from the start of each movie kept decoded so a button press shows the movie straight away.
+VIDEO_PREROLL_FRAMES = 10
+# How long the water and wind motors run after their button is pressed.
+MOTOR_RUN_SECONDS = 8
+
 
 def load_images():
     # 1920x1080 Pixels for second Screen
@@ -85,15 +121,23 @@ def load_images():
     loaded_images = {}
     for name, image_path in images.items():
         try:
+            decode_start = time.perf_counter()
             loaded_image = pygame.image.load(image_path)
             if loaded_image is None:
                 print(f"Image {image_path} did not load correctly")
-            else:
-                print(f"Image {image_path}loaded successfully")
+                continue
+            convert_start = time.perf_counter()
+            loaded_image = convert_image(loaded_image)
+            convert_end = time.perf_counter()
+            print(
+                f"Image {image_path} loaded successfully "
+                f"(decode {(convert_start - decode_start) * 1000:.0f} ms, "
+                f"convert {(convert_end - convert_start) * 1000:.0f} ms)"
+            )
             loaded_images[name] = loaded_image
         except pygame.error:
             print(f"Failed to load image: {image_path}")
-    return loaded_images
+    return loaded_images, compose_scenes(loaded_images)
 
 
 # Load up the movies to play on the screen
@@ -105,7 +149,8 @@ def load_movies():
     loaded_movies = {}
     for name, movie_path in movies.items():
         try:
-            loaded_movie = Video(movie_path)  # use_pygame_audio=True Failed.
+            # Decoding runs on the video's own thread, so a slow frame never holds up the main loop.
+            loaded_movie = ThreadedVideo(movie_path, preroll=VIDEO_PREROLL_FRAMES)
             loaded_movie.mute()
             if loaded_movie is None:
                 print(f"Movie {movie_path} did not load correctly")
@@ -203,9 +248,36 @@ def get_screen_resolution():
     return (screen.current_w, screen.current_h)
 
 
+# Draw a scene on the right screen and update only that area, skipping it if already showing.
+def render_scene(name):
+    global last_scene
+    if name == last_scene:
+        return
+    last_scene = name
+    pygame.display.update(pygame_screen.blit(pygame_scenes[name], RIGHT_SCREEN_POS))
+
+
 water_started = datetime.datetime.now()
 wind_started = datetime.datetime.now()
 
+# The motor sounds that are playing. Each loops from when its motor starts until it stops, rather than
+# being started again on every workflow run.
+sounds_playing = set()
+
+
+def start_sound(name):
+    if name in sounds_playing:
+        return
+    sounds_playing.add(name)
+    pygame_sounds[name].play(loops=-1)
+
+
+def stop_sound(name):
+    if name not in sounds_playing:
+        return
+    sounds_playing.discard(name)
+    pygame_sounds[name].stop()
+
 
 def workflow_engine():
     global SOLAR
@@ -219,67 +291,40 @@ def workflow_engine():
     # Display Houses Lights based on SOLAR, Hydro, and Wind power.
     if SOLAR == 0 and WATER == 0 and WIND == 0:
         # print("No power - Turn all houses lights OFF")
-        GPIO.output(HOUSE1_GPIO, GPIO.LOW)
-        GPIO.output(HOUSE2_GPIO, GPIO.LOW)
-        GPIO.output(HOUSE3_GPIO, GPIO.LOW)
-        GPIO.output(HOUSE4_GPIO, GPIO.LOW)
+        OUTPUTS.write(house_lights(0))
         # Display that houses have no power.
-        pygame_screen.blit(pygame_images["sunset"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunsetcontrols"], (1921, 0))
-        pygame.display.update()
+        render_scene("sunset")
     elif SOLAR == 1 and WATER == 0 and WIND == 0:
         # print("Half Power - Turn 3 houses lights OFF")
-        GPIO.output(HOUSE1_GPIO, GPIO.HIGH)
-        GPIO.output(HOUSE2_GPIO, GPIO.LOW)
-        GPIO.output(HOUSE3_GPIO, GPIO.LOW)
-        GPIO.output(HOUSE4_GPIO, GPIO.LOW)
-        pygame_screen.blit(pygame_images["sunshadebg"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunshade"], (1921, 0))
-        pygame.display.update()
+        OUTPUTS.write(house_lights(1))
+        render_scene("sunshade")
     elif SOLAR == 2 and WATER == 0 and WIND == 0:
         # print("We have SUN - Turn all houses lights ON")
-        GPIO.output(HOUSE1_GPIO, GPIO.HIGH)
-        GPIO.output(HOUSE2_GPIO, GPIO.HIGH)
-        GPIO.output(HOUSE3_GPIO, GPIO.HIGH)
-        GPIO.output(HOUSE4_GPIO, GPIO.HIGH)
-        pygame_screen.blit(pygame_images["sunoutbg"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunout"], (1921, 0))
-        pygame.display.update()
+        OUTPUTS.write(house_lights(4))
+        render_scene("sunout")
     elif WATER == 1:
-        if datetime.datetime.now() - water_started > datetime.timedelta(seconds=8):
-            GPIO.output(WATER_GPIO, GPIO.HIGH)
+        if datetime.datetime.now() - water_started > datetime.timedelta(seconds=MOTOR_RUN_SECONDS):
+            OUTPUTS.write({"water": GPIO.HIGH})
             WATER = 0
-            pygame_sounds["hydro"].stop()
+            stop_sound("hydro")
         else:
             # print("Hydro Power - Turn 2 houses lights ON")
-            GPIO.output(HOUSE1_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE2_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE3_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE4_GPIO, GPIO.HIGH)
-            pygame_screen.blit(pygame_images["hydrobg"], (1921, 0))
-            pygame_screen.blit(pygame_images["hydro"], (1921, 0))
-            pygame.display.update()
-            # Set the Relay for Water Motors GPIO Pins to LOW
-            GPIO.output(WATER_GPIO, GPIO.LOW)
-            pygame_sounds["hydro"].play()
+            # Set the Relay for Water Motors GPIO Pins to LOW, with all the houses lit
+            OUTPUTS.write({**house_lights(4), "water": GPIO.LOW})
+            render_scene("hydro")
+            start_sound("hydro")
             # sleep for 10 seconds to simulate the water turbines spinning up
     elif WIND == 1:
-        if datetime.datetime.now() - wind_started > datetime.timedelta(seconds=8):
-            GPIO.output(WIND_GPIO, GPIO.HIGH)
+        if datetime.datetime.now() - wind_started > datetime.timedelta(seconds=MOTOR_RUN_SECONDS):
+            OUTPUTS.write({"wind": GPIO.HIGH})
             WIND = 0
-            pygame_sounds["wind"].stop()
+            stop_sound("wind")
         else:
             # print("Wind Power - Turn 1 house lights ON")
-            GPIO.output(HOUSE1_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE2_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE3_GPIO, GPIO.HIGH)
-            GPIO.output(HOUSE4_GPIO, GPIO.HIGH)
-            pygame_screen.blit(pygame_images["windbg"], (1921, 0))
-            pygame_screen.blit(pygame_images["wind"], (1921, 0))
-            pygame.display.update()
-            # Set the Relay for Wind Motors GPIO Pins to LOW
-            GPIO.output(WIND_GPIO, GPIO.LOW)
-            pygame_sounds["wind"].play()
+            # Set the Relay for Wind Motors GPIO Pins to LOW, with all the houses lit
+            OUTPUTS.write({**house_lights(4), "wind": GPIO.LOW})
+            render_scene("wind")
+            start_sound("wind")
     else:
         print("Ummmm")
 
@@ -307,6 +352,9 @@ def sunshade_action(channel=None):
 def hydro_action(channel=None):
     global WATER
     global water_started
+    # Start Playing the video if not already playing
+    if pygame_movie.active == False:
+        pygame_movie.play()
     # check if WATER is already 1
     WATER = 1
     water_started = datetime.datetime.now()
@@ -319,6 +367,43 @@ def wind_action(channel=None):
     WIND = 1
 
 
+# Wrap a GPIO callback so it wakes the main loop once it has run.
+def gpio_callback(callback):
+    def wake_main_loop(channel=None):
+        callback(channel)
+        try:
+            pygame.event.post(pygame.event.Event(GPIO_EVENT))
+        except pygame.error:
+            # An edge after pygame has shut down.
+            pass
+
+    return wake_main_loop
+
+
+# Milliseconds until the run of the motor the workflow engine is timing is up, or None if neither motor is
+# running. Like the engine, only times the wind motor once the water motor has stopped.
+def time_until_motor_stops():
+    if WATER == 1:
+        started = water_started
+    elif WIND == 1:
+        started = wind_started
+    else:
+        return None
+    run_ends = started + datetime.timedelta(seconds=MOTOR_RUN_SECONDS)
+    return (run_ends - datetime.datetime.now()).total_seconds() * 1000
+
+
+# Block until there are events. With a timeout, returns an empty list if nothing happened in time.
+def wait_for_events(timeout=None):
+    if timeout is None:
+        event = pygame.event.wait()
+    else:
+        event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
+
+
 def main():
     # Access Global Variables
     global SOLAR
@@ -327,7 +412,9 @@ def main():
     global STATE_CHANGED
     global pygame_screen
     global pygame_images
+    global pygame_scenes
     global pygame_sounds
+    global pygame_movie
 
     # Monitor GPIO20 - Sunset
     # GPIO21 - Sun behind clouds.
@@ -342,21 +429,13 @@ def main():
     GPIO.setup(SUNSET_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
     GPIO.setup(SUNBEHIND_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    # Set the Relay for Motors GPIO Pins to Output and set to HIGH
-    GPIO.setup(WATER_GPIO, GPIO.OUT, initial=GPIO.HIGH)  # Water Turbine
-    GPIO.setup(3, GPIO.OUT, initial=GPIO.HIGH)  # Wind Turbine
     # Set GPIO 19 and 26 to be an input for the 2 buttons
     GPIO.setup(BUTTON1_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_UP)
     GPIO.setup(BUTTON2_GPIO, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    # Set GPIO 1,7,8,25 to be outputs for the LEDS on the houses
-    GPIO.setup(HOUSE1_GPIO, GPIO.OUT, initial=GPIO.LOW)
-    GPIO.setup(HOUSE2_GPIO, GPIO.OUT, initial=GPIO.LOW)
-    GPIO.setup(HOUSE3_GPIO, GPIO.OUT, initial=GPIO.LOW)
-    GPIO.setup(HOUSE4_GPIO, GPIO.OUT, initial=GPIO.LOW)
     # Get Pygame setup
     pygame_screen = setup_pygame()
     # Load the Images
-    pygame_images = load_images()
+    pygame_images, pygame_scenes = load_images()
     # Load the Movies
     pygame_movies = load_movies()
     # Load the Sounds
@@ -373,8 +452,7 @@ def main():
     #    )
     #    pygame.display.flip()
     # Load dawn start image and display on the far right side of the screen
-    pygame_screen.blit(pygame_images["startbg"], (1921, 0))
-    pygame_screen.blit(pygame_images["start"], (1921, 0))
+    pygame_screen.blit(pygame_scenes["start"], RIGHT_SCREEN_POS)
     # Draw the text "Coming soon" on the screen
     # draw_text(pygame_screen, "Coming soon", 100, 100)
     # draw_text(pygame_screen, "Sustainability Display", 100, 300)
@@ -397,90 +475,94 @@ def main():
     GPIO.add_event_detect(
         SUNSET_GPIO,
         GPIO.BOTH,
-        callback=sunrise_sunset_action,
+        callback=gpio_callback(sunrise_sunset_action),
         bouncetime=200,
     )
     GPIO.add_event_detect(
         SUNBEHIND_GPIO,
         GPIO.BOTH,
-        callback=sunshade_action,
+        callback=gpio_callback(sunshade_action),
         bouncetime=200,
     )
 
     GPIO.add_event_detect(
         BUTTON1_GPIO,
         GPIO.FALLING,
-        callback=hydro_action,
+        callback=gpio_callback(hydro_action),
         bouncetime=100,
     )
 
     GPIO.add_event_detect(
         BUTTON2_GPIO,
         GPIO.FALLING,
-        callback=wind_action,
+        callback=gpio_callback(wind_action),
         bouncetime=100,
     )
     # Check initial state of the GPIO for first time load.
     # if GPIO.input(SUNSET_GPIO) == PI_HIGH:
     #    sunrise_action()
 
-    # Record a timer for th Pi Output check, as we only want to run that loop every 0.5 seconds
-    last_time = datetime.datetime.now()
+    # The state only changes in the GPIO callbacks, so the workflow only runs after one, or when a
+    # motor's run is up.
+    run_workflow = True
 
     while running:
+        # Sleep until a GPIO callback or key press wakes us. Only wake on a timeout while the video plays
+        # or a motor runs.
+        wake_after = []
         if pygame_movie.active == True:
-            if pygame_movie.draw(pygame_screen, (0, 0), force_draw=False):
-                pygame.display.update()
-
-        # if pygame_movie.active == False:
-        # pygame_movie.restart()
-        # Check to see if the time is greater than 0.5 seconds as we only check the Pi Outputs every 0.4 seconds to keep any video happy.
-        if datetime.datetime.now() - last_time > datetime.timedelta(seconds=0.1):
-            last_time = datetime.datetime.now()
-            # Check the status of the PIN
-            # Print out status of global variables
-            # print(f"SOLAR: {SOLAR}, WATER: {WATER}, WIND: {WIND}")
-            # draw_text(
-            #    pygame_screen,
-            #    f"SOLAR: {SOLAR}, WATER: {WATER}, WIND: {WIND}",
-            #    2000,
-            #    140,
-            # )
+            wake_after.append(VIDEO_WAKE_MS)
+        motor_stops_in = time_until_motor_stops()
+        if motor_stops_in is not None:
+            wake_after.append(motor_stops_in)
+        if run_workflow:
+            events = pygame.event.get()
+        elif wake_after:
+            # pygame.event.wait(0) would wait forever, so never ask for less than 1 ms.
+            events = wait_for_events(max(1, math.ceil(min(wake_after))))
+        else:
+            events = wait_for_events()
+
+        for event in events:
+            if event.type == GPIO_EVENT:
+                run_workflow = True
+            elif event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_s:
+                    # Code to handle "s" key press event
+                    # Add your logic here
+                    SOLAR = 2
+                    run_workflow = True
+                if event.key == pygame.K_h:
+                    # Code to handle "h" key press event
+                    # Hide the screen so that I can see the console
+                    pygame.display.iconify()
+                if event.key == pygame.K_f:
+                    # Code to handle "f" key press event
+                    # Hide the screen so that I can see the console
+                    pygame.display.toggle_fullscreen()
+
+        motor_stops_in = time_until_motor_stops()
+        if motor_stops_in is not None and motor_stops_in < 0:
+            run_workflow = True
+        if run_workflow:
+            run_workflow = False
+            state = (SOLAR, WATER, WIND)
             # Run the workflow engine to check the status of the GPIO and update the screen
             workflow_engine()
+            # Stopping a motor changes the state without drawing the scene that follows, so run it again.
+            if (SOLAR, WATER, WIND) != state:
+                run_workflow = True
 
-            if GPIO.input(BUTTON1_GPIO) == PI_LOW:
-                # print("Button 1 Pressed")
-                # Start Playing the video if not already playing
-                if pygame_movie.active == False:
-                    pygame_movie.play()
-
-            # Display Houses Lights based on SOLAR, Hydro, and Wind power.
-            # Full Power
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    running = False
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_s:
-                        # Code to handle "s" key press event
-                        # Add your logic here
-                        SOLAR = 2
-                    if event.key == pygame.K_h:
-                        # Code to handle "h" key press event
-                        # Hide the screen so that I can see the console
-                        pygame.display.iconify()
-                    if event.key == pygame.K_f:
-                        # Code to handle "f" key press event
-                        # Hide the screen so that I can see the console
-                        pygame.display.toggle_fullscreen()
-        # print("Waiting... 1 second.")
-        # time.sleep(0.1)
-        pygame.time.wait(15)  # around 60 fps
+        if pygame_movie.active == True:
+            if pygame_movie.draw(pygame_screen, (0, 0), force_draw=False):
+                pygame.display.update(LEFT_SCREEN_RECT)
     # Quit Pygame
     pygame_movie.stop()
+    pygame_movie.close()
     pygame.quit()
     sys.exit()
 
@@ -1,14 +1,30 @@
 #!/usr/bin/env python3
 
 import time
-import datetime
+
+# When the script started, for reporting how long each stage of startup takes.
+load_started = time.perf_counter()
+
 import sys
 import os
-import threading
-from gpiozero import Button, LED, OutputDevice
+import collections
+import functools
+import heapq
+import itertools
+import math
+import mmap
+import random
+import struct
+import wave
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pygame
 from pygame.locals import *
-from pyvidplayer2 import Video
+from gpio_backend import HOUSES, house_lights, open_outputs
+from scenes import SCENES, compose_scene, compose_scenes, convert_image
+from edge_filter import EdgeFilter, EdgeRule
+
+# gpiozero, gpio_trace and videoplayer (which brings in OpenCV and numpy) are imported when they are
+# first needed, so the start scene can go up before they are loaded. See main().
 
 # Constants
 PI_HIGH = 1
@@ -19,73 +35,208 @@ SOLAR = 0  # 0 = No Sun, 1 = LOW Sunlight, 2 = Full Sun
 WATER = 0  # 0 = No Water, 1 = LOW Water, 2 = Full Water
 WIND = 0  # 0 = No Wind, 1 = LOW Wind, 2 = Full Wind
 
-# Define GPIO pins using gpiozero components
-SUNSET_BUTTON = Button(20, pull_up=True, bounce_time=0.5)
-SUNBEHIND_BUTTON = Button(21, pull_up=True, bounce_time=0.5)
-BUTTON1 = Button(19)
-BUTTON2 = Button(26)
-LEFT_STOP_SENSOR = Button(12, pull_up=True, bounce_time=0.5)
-RIGHT_STOP_SENSOR = Button(16, pull_up=True, bounce_time=0.5)
+# The gpiozero input devices and the outputs, created by setup_gpio() once the start scene is up.
+SUNSET_BUTTON = SUNBEHIND_BUTTON = BUTTON1 = BUTTON2 = LEFT_STOP_SENSOR = RIGHT_STOP_SENSOR = None
+OUTPUTS = None
 
-# LEDs for houses
-HOUSE1 = LED(1)
-HOUSE2 = LED(7)
-HOUSE3 = LED(8)
-HOUSE4 = LED(25)
-
-# Output devices for motors
-WATER_MOTOR = OutputDevice(2, initial_value=True)  # Water Turbine motor
-WIND_MOTOR = OutputDevice(3, initial_value=True)  # Wind Turbine motor
+# Debounce rules, see edge_filter.py. The sun sensors flap when the sun sits on the edge of one, so once
+# they change they hold for half a second. A real change still gets through in 50 ms, where gpiozero's
+# bounce_time=0.5 held every change back for half a second.
+SUN_SENSOR_EDGES = EdgeRule(stable=0.05, hysteresis=0.5, samples=2)
+BUTTON_EDGES = EdgeRule(stable=0.01, hysteresis=0.0, samples=1)
+STOP_SENSOR_EDGES = EdgeRule(stable=0.02, hysteresis=0.2, samples=1)
 
 # Has STATE Changed?
 STATE_CHANGED = False
 
 # Shared variables for thread control
-stop_event = threading.Event()
 video_playing = False
 
+# Screen layout. The left monitor shows the video, the right monitor shows the scenes.
+LEFT_SCREEN_RECT = pygame.Rect(0, 0, 1920, 1080)
+RIGHT_SCREEN_POS = (1921, 0)
+
+# Number of threads used to decode assets at startup, one per Pi 5 core.
+ASSET_LOADER_WORKERS = 4
+
+# Decoded images are cached here in display pixel format, so restarts can skip PNG/JPEG decoding.
+IMAGE_CACHE_DIR = "images/cache"
+# Header: magic, width, height, has alpha, source file mtime (ns) and size.
+IMAGE_CACHE_HEADER = struct.Struct("<4sIIBqq")
+IMAGE_CACHE_MAGIC = b"SRF1"
+
+# Posted by the GPIO callbacks to wake the main loop.
+GPIO_EVENT = pygame.event.custom_type()
+# How often the debug overlay is refreshed, and how often the loop wakes to draw the video while it plays.
+WORKFLOW_TICK_MS = 100
+VIDEO_WAKE_MS = 10
+# Frames from the start of each movie kept decoded so a button press shows the movie straight away.
+# About 6 MB each at 1080p.
+VIDEO_PREROLL_FRAMES = 10
+
+# Rectangles drawn since the last display update, and the scene currently on the right screen.
+dirty_rects = []
+last_scene = None
+
+
+IMAGES = {
+    "start": "images/renewableenergy01.png",
+    "startbg": "images/renewableenergybg01.jpg",
+    "sunshade": "images/renewableenergy07.png",
+    "sunshadebg": "images/renewableenergybg07.jpg",
+    "sunout": "images/renewableenergy03.png",
+    "sunoutbg": "images/renewableenergybg03.jpg",
+    "sunset": "images/renewableenergybg10.jpg",
+    "sunsetcontrols": "images/renewableenergy09.png",
+    "sunrise": "images/dawn.png",
+    "leftscreen": "images/leftmonitor.jpeg",
+    "hydro": "images/renewableenergy02.png",
+    "hydrobg": "images/renewableenergybg08.jpg",
+    "wind": "images/renewableenergy05.png",
+    "windbg": "images/renewableenergybg05.jpg",
+    "turnright": "images/turnleft.png",
+    "turnleft": "images/turnright.png",
+}
+
+# Runs on a loader thread. Uses the decoded cache if it is up to date, otherwise decodes the file.
+# pygame releases the GIL while SDL_image decodes.
+def decode_image(image_path, use_cache):
+    decode_start = time.perf_counter()
+    loaded_image = load_cached_image(image_path) if use_cache else None
+    from_cache = loaded_image is not None
+    if not from_cache:
+        loaded_image = pygame.image.load(image_path)
+    return loaded_image, time.perf_counter() - decode_start, from_cache
+
+
+def image_cache_path(image_path):
+    return os.path.join(IMAGE_CACHE_DIR, os.path.basename(image_path) + ".bgra")
+
+
+# Cached pixels are stored as BGRA, which is the memory layout of the Pi's XRGB8888 display.
+def image_cache_supported():
+    return pygame.display.get_surface().get_masks()[:3] == (0xFF0000, 0xFF00, 0xFF)
+
+
+# Memory map a cached image and wrap the pixels as a surface, without copying or decoding them.
+# The page cache is shared between restarts, so after the first run this costs next to nothing.
+def load_cached_image(image_path):
+    cache_path = image_cache_path(image_path)
+    try:
+        source = os.stat(image_path)
+        with open(cache_path, "rb") as cache_file:
+            cache_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(cache_map) < IMAGE_CACHE_HEADER.size:
+        return None
+    magic, width, height, has_alpha, mtime_ns, size = IMAGE_CACHE_HEADER.unpack_from(cache_map)
+    if (
+        magic != IMAGE_CACHE_MAGIC
+        or mtime_ns != source.st_mtime_ns
+        or size != source.st_size
+        or len(cache_map) != IMAGE_CACHE_HEADER.size + width * height * 4
+    ):
+        # The source image has changed since the cache was written.
+        return None
+    pixels = memoryview(cache_map)[IMAGE_CACHE_HEADER.size :]
+    cached_image = pygame.image.frombuffer(pixels, (width, height), "BGRA")
+    if not has_alpha:
+        cached_image.set_alpha(None)
+    return cached_image
+
+
+# Write a converted image to the cache. Written to a temporary file first so a crash can't leave half a file.
+def save_cached_image(image_path, image):
+    cache_path = image_cache_path(image_path)
+    source = os.stat(image_path)
+    width, height = image.get_size()
+    has_alpha = bool(image.get_flags() & pygame.SRCALPHA)
+    header = IMAGE_CACHE_HEADER.pack(
+        IMAGE_CACHE_MAGIC, width, height, has_alpha, source.st_mtime_ns, source.st_size
+    )
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    with open(cache_path + ".tmp", "wb") as cache_file:
+        cache_file.write(header)
+        cache_file.write(pygame.image.tobytes(image, "BGRA"))
+    os.replace(cache_path + ".tmp", cache_path)
+
 
-def load_images():
-    images = {
-        "start": "images/renewableenergy01.png",
-        "startbg": "images/renewableenergybg01.jpg",
-        "sunshade": "images/renewableenergy07.png",
-        "sunshadebg": "images/renewableenergybg07.jpg",
-        "sunout": "images/renewableenergy03.png",
-        "sunoutbg": "images/renewableenergybg03.jpg",
-        "sunset": "images/renewableenergybg10.jpg",
-        "sunsetcontrols": "images/renewableenergy09.png",
-        "sunrise": "images/dawn.png",
-        "leftscreen": "images/leftmonitor.jpeg",
-        "hydro": "images/renewableenergy02.png",
-        "hydrobg": "images/renewableenergybg08.jpg",
-        "wind": "images/renewableenergy05.png",
-        "windbg": "images/renewableenergybg05.jpg",
-        "turnright": "images/turnleft.png",
-        "turnleft": "images/turnright.png",
-    }
+# Decode the named images on the executor's threads and convert them on the main thread as they finish.
+def load_images(executor, names=IMAGES):
     loaded_images = {}
-    for name, image_path in images.items():
+    use_image_cache = image_cache_supported()
+    if not use_image_cache:
+        print("Display is not XRGB8888, not using the image cache")
+    futures = {
+        executor.submit(decode_image, IMAGES[name], use_image_cache): name
+        for name in names
+    }
+    for future in as_completed(futures):
+        name = futures[future]
+        image_path = IMAGES[name]
         try:
-            loaded_image = pygame.image.load(image_path)
+            loaded_image, decode_time, from_cache = future.result()
             if loaded_image is None:
                 print(f"Image {image_path} did not load correctly")
+                continue
+            if from_cache:
+                print(f"Image {image_path} loaded from cache ({decode_time * 1000:.0f} ms)")
             else:
-                print(f"Image {image_path} loaded successfully")
+                convert_start = time.perf_counter()
+                loaded_image = convert_image(loaded_image)
+                convert_end = time.perf_counter()
+                print(
+                    f"Image {image_path} loaded successfully "
+                    f"(decode {decode_time * 1000:.0f} ms, "
+                    f"convert {(convert_end - convert_start) * 1000:.0f} ms)"
+                )
+                if use_image_cache:
+                    try:
+                        save_cached_image(image_path, loaded_image)
+                    except OSError as e:
+                        print(f"Failed to write image cache for: {image_path}")
+                        print(e)
             loaded_images[name] = loaded_image
         except pygame.error:
             print(f"Failed to load image: {image_path}")
     return loaded_images
 
 
+def show_start_scene(loaded_images):
+    if not all(layer in loaded_images for layer in SCENES["start"]):
+        print("Start scene is missing images, not showing it")
+        return
+    start_scene = compose_scene(SCENES["start"], loaded_images)
+    pygame.display.update(pygame_screen.blit(start_scene, RIGHT_SCREEN_POS))
+    startup_step("Start scene shown")
+
+
+# Print how long after the script started a stage of startup finished.
+def startup_step(step):
+    print(f"{step} after {(time.perf_counter() - load_started) * 1000:.0f} ms")
+
+
+# Runs on a loader thread, so importing OpenCV doesn't hold up the start scene.
 def load_movies():
+    import_started = time.perf_counter()
+    from videoplayer import ThreadedVideo
+
+    print(f"Imported videoplayer in {(time.perf_counter() - import_started) * 1000:.0f} ms")
     movies = {
         "hydro": "images/howdoeshydropowerwork1080p.mp4",
     }
     loaded_movies = {}
     for name, movie_path in movies.items():
         try:
-            loaded_movie = Video(movie_path)
+            # Decodes on its own thread so a slow frame never holds up the main loop.
+            # Plays from the movie's frame store instead if one has been built with videoplayer.py.
+            # Falls back to the 720p encode, if there is one, when the Pi can't keep up.
+            loaded_movie = ThreadedVideo(
+                movie_path,
+                low_quality_path=movie_path.replace("1080p", "720p"),
+                preroll=VIDEO_PREROLL_FRAMES,
+            )
             loaded_movie.mute()
             loaded_movies[name] = loaded_movie
         except Exception as e:
@@ -94,22 +245,68 @@ def load_movies():
     return loaded_movies
 
 
+# Ambient beds longer than this many seconds, or that would take the decoded sounds over the memory
+# budget, are streamed from disk when they play instead of being decoded into memory at startup. Only
+# the beds are streamed: there is a single music stream, and a motor loop taking it over would cut the
+# bed off. The motor loops are always decoded into memory.
+AMBIENT_BEDS = ("night",)
+SOUND_RESIDENT_SECONDS = 15
+SOUND_MEMORY_BUDGET = 32 * 1024 * 1024
+SOUND_VOLUME = 0.5
+
+
+# Use a compressed copy of a sound next to the WAV if there is one.
+def sound_file(sound_path):
+    stem = os.path.splitext(sound_path)[0]
+    for extension in (".ogg", ".flac"):
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return sound_path
+
+
+# Length in seconds and bytes once decoded into the mixer's format, or (None, None) if that can't be
+# told without decoding the whole file.
+def decoded_sound_size(sound_path):
+    os.stat(sound_path)  # Fail here if the file is missing.
+    try:
+        with wave.open(sound_path) as wav:
+            seconds = wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return None, None
+    frequency, size, channels = pygame.mixer.get_init()
+    return seconds, int(seconds * frequency * channels * abs(size) // 8)
+
+
+# Returns a Sound for each sound that is decoded into memory, and the file path for each that is streamed.
 def load_sounds():
     sounds = {
         "hydro": "sounds/waterfallmono.wav",
         "wind": "sounds/wind.wav",
         "night": "sounds/swamp.wav",
+        "owl": "sounds/owl-hooting.wav",
     }
     loaded_sounds = {}
+    resident_bytes = 0
     pygame.mixer.init(buffer=4096)  # Increase buffer size if needed
     for name, sound_path in sounds.items():
+        sound_path = sound_file(sound_path)
         try:
+            seconds, size = decoded_sound_size(sound_path)
+            if name in AMBIENT_BEDS and (
+                seconds is None or seconds > SOUND_RESIDENT_SECONDS or resident_bytes + size > SOUND_MEMORY_BUDGET
+            ):
+                loaded_sounds[name] = sound_path
+                print(f"Sound {sound_path} will be streamed")
+                continue
             loaded_sound = pygame.mixer.Sound(sound_path)
-            loaded_sound.set_volume(0.5)
+            loaded_sound.set_volume(SOUND_VOLUME)
             loaded_sounds[name] = loaded_sound
+            # A compressed sound's size is only known once it has been decoded.
+            resident_bytes += size if size is not None else len(loaded_sound.get_raw())
         except Exception as e:
             print(f"Failed to load sound: {sound_path}")
             print(e)
+    print(f"Sounds in memory: {resident_bytes / 1024 / 1024:.1f} MB of {SOUND_MEMORY_BUDGET / 1024 / 1024:.0f} MB")
     return loaded_sounds
 
 
@@ -131,8 +328,10 @@ def setup_pygame():
     if not FindDisplayDriver():
         print("Failed to initialise display driver")
         sys.exit(1)
+    # Only the fonts are needed before the start scene. The mixer is opened by load_sounds() on a
+    # loader thread, which pygame.init() would otherwise do here, before anything is on screen.
+    pygame.font.init()
     # Set the display to fullscreen
-    pygame.init()
     info = pygame.display.Info()
     width = info.current_w
     height = info.current_h
@@ -145,12 +344,239 @@ def setup_pygame():
     return screen
 
 
-# Function to draw text on the screen in large font
-def draw_text(screen, text, x, y):
-    font = pygame.font.Font(None, 96)
-    text = font.render(text, 1, (255, 255, 255))
-    screen.blit(text, (x, y))
-    # pygame.display.flip()
+# Fonts are loaded once per size and kept.
+@functools.lru_cache(maxsize=None)
+def get_font(size):
+    return pygame.font.Font(None, size)
+
+
+# Rendered strings are kept, dropping the least recently used once the cache is full.
+@functools.lru_cache(maxsize=128)
+def render_text(text, size, colour):
+    return get_font(size).render(text, True, colour)
+
+
+# Function to draw text on the screen in large font.
+# Strings that change all the time, like counters and timings, are drawn a character at a time from
+# cached glyphs so each new value doesn't need rendering or fill the string cache.
+def draw_text(screen, text, x, y, size=96, colour=(255, 255, 255), per_glyph=False):
+    if not per_glyph:
+        return screen.blit(render_text(text, size, colour), (x, y))
+    text_rect = pygame.Rect(x, y, 0, 0)
+    for character in text:
+        glyph = render_text(character, size, colour)
+        text_rect.union_ip(screen.blit(glyph, (x, y)))
+        x += glyph.get_width()
+    return text_rect
+
+
+# Rolling timings for the debug overlay, in seconds. Only recorded while the overlay is on.
+PERF_WINDOW = 300
+perf_timings = {
+    name: collections.deque(maxlen=PERF_WINDOW)
+    for name in ("frame", "workflow", "video", "events", "input")
+}
+gpio_callbacks = 0
+gpio_callbacks_seen = 0
+gpio_callbacks_seen_at = time.perf_counter()
+
+
+# Raw edges waiting for their edge filter. gpiozero's threads only append to it and the main loop only
+# pops from it, which a deque does safely without a lock.
+raw_edges = collections.deque()
+# GPIO input events as (edge time, action), queued on the main loop by the edge filters as they pass
+# changes on. They are kept apart from raw_edges so only the actions count as callbacks. The actions run
+# on the main loop too, so the game state, the movie and the sounds are only ever touched from there.
+gpio_events = collections.deque()
+
+
+def wake_main_loop():
+    try:
+        pygame.event.post(pygame.event.Event(GPIO_EVENT))
+    except pygame.error:
+        # An edge after pygame has shut down.
+        pass
+
+
+# The monotonic time of the edge an edge filter is passing on, while its device's handlers run.
+passing_edge_time = None
+
+
+# Wrap a GPIO callback so it queues its action with the time of the edge and wakes the main loop.
+def gpio_callback(callback):
+    def queue_event():
+        edge_time = passing_edge_time if passing_edge_time is not None else time.monotonic()
+        gpio_events.append((edge_time, callback))
+        wake_main_loop()
+
+    return queue_event
+
+
+# Put an edge filter between each input pin and its gpiozero device. Raw edges are queued to the main
+# loop with the time they happened, and the device only sees the changes the filter passes on.
+edge_filters = {}
+
+# Edge timestamps more than this many seconds old are taken as this old. The pin library's tick origin
+# depends on the kernel, and if it isn't the monotonic clock's, unclamped edge times would put every
+# filter check far in the future and no input would ever be accepted.
+EDGE_TIME_WINDOW = 0.5
+
+
+def filter_edges(device, rule):
+    pin = device.pin
+    factory = pin.factory
+    device_handler = pin.when_changed
+    # A replay drives the pins faster than the edges happened. The filter then runs on the trace's clock,
+    # so it passes and drops the same edges it would have on the day.
+    speed = getattr(factory, "speed", 1.0)
+
+    def filter_clock():
+        return time.monotonic() * speed
+
+    edge_filter = EdgeFilter(rule, pin.state, filter_clock())
+    check_timer = None
+
+    def on_edge(ticks, state):
+        # ticks is the edge's timestamp from the pin library, put it on the filter's clock.
+        now = filter_clock()
+        age = min(max(0.0, factory.ticks_diff(factory.ticks(), ticks)), EDGE_TIME_WINDOW)
+        raw_edges.append(lambda: filter_edge(now - age * speed, state, ticks))
+        wake_main_loop()
+
+    def filter_edge(edge_time, state, ticks):
+        edge_filter.edge(edge_time, state, ticks)
+        schedule_check()
+
+    def check_edge():
+        global passing_edge_time
+        if edge_filter.check(filter_clock(), pin.state):
+            # The actions are queued with the time of the edge, not the time the filter let it through,
+            # so the input latency includes the filter's wait.
+            passing_edge_time = edge_filter.pending_since / speed
+            try:
+                device_handler(edge_filter.pending_data, edge_filter.level)
+            finally:
+                passing_edge_time = None
+        schedule_check()
+
+    def schedule_check():
+        nonlocal check_timer
+        cancel(check_timer)
+        check_timer = None
+        due = edge_filter.due_time()
+        if due is not None:
+            check_timer = schedule(max(0.0, (due - filter_clock()) / speed), check_edge)
+
+    # The pin only keeps a weak reference to its handler.
+    edge_filters[device] = (edge_filter, on_edge)
+    pin.when_changed = on_edge
+
+
+def edge_bounces():
+    return sum(edge_filter.bounces for edge_filter, on_edge in edge_filters.values())
+
+
+# Create the input devices and outputs, put the edge filters on the inputs and bind their actions.
+# Does nothing if it has already been done.
+def setup_gpio():
+    global SUNSET_BUTTON, SUNBEHIND_BUTTON, BUTTON1, BUTTON2, LEFT_STOP_SENSOR, RIGHT_STOP_SENSOR, OUTPUTS
+    if OUTPUTS is not None:
+        return
+    from gpiozero import Button
+
+    SUNSET_BUTTON = Button(20, pull_up=True)
+    SUNBEHIND_BUTTON = Button(21, pull_up=True)
+    BUTTON1 = Button(19)
+    BUTTON2 = Button(26)
+    LEFT_STOP_SENSOR = Button(12, pull_up=True)
+    RIGHT_STOP_SENSOR = Button(16, pull_up=True)
+    # The relays are active low, so the motors start stopped. All of the outputs are written together
+    # in one call where the backend allows.
+    OUTPUTS = open_outputs(
+        {"house1": 1, "house2": 7, "house3": 8, "house4": 25, "water": 2, "wind": 3},
+        initial={"water": 1, "wind": 1},
+        default_backend="gpiozero",
+    )
+
+    filter_edges(SUNSET_BUTTON, SUN_SENSOR_EDGES)
+    filter_edges(SUNBEHIND_BUTTON, SUN_SENSOR_EDGES)
+    filter_edges(BUTTON1, BUTTON_EDGES)
+    filter_edges(BUTTON2, BUTTON_EDGES)
+    filter_edges(LEFT_STOP_SENSOR, STOP_SENSOR_EDGES)
+    filter_edges(RIGHT_STOP_SENSOR, STOP_SENSOR_EDGES)
+    SUNSET_BUTTON.when_pressed = gpio_callback(sunset_action)
+    SUNSET_BUTTON.when_released = gpio_callback(sunout_action)
+    SUNBEHIND_BUTTON.when_pressed = gpio_callback(sunshade_action)
+    SUNBEHIND_BUTTON.when_released = gpio_callback(sunout_action)
+    BUTTON1.when_pressed = gpio_callback(hydro_action)
+    BUTTON2.when_pressed = gpio_callback(wind_action)
+    LEFT_STOP_SENSOR.when_pressed = gpio_callback(left_stop_sensor_pressed)
+    LEFT_STOP_SENSOR.when_released = gpio_callback(left_stop_sensor_released)
+    RIGHT_STOP_SENSOR.when_pressed = gpio_callback(right_stop_sensor_pressed)
+    RIGHT_STOP_SENSOR.when_released = gpio_callback(right_stop_sensor_released)
+
+
+# Pass the queued raw edges to their edge filters.
+def run_raw_edges():
+    while raw_edges:
+        raw_edges.popleft()()
+
+
+# Run one queued GPIO action, recording the time from its edge when asked.
+def run_gpio_event(edge_time, callback, record_latency):
+    global gpio_callbacks
+    callback()
+    gpio_callbacks += 1
+    if record_latency:
+        perf_timings["input"].append(time.monotonic() - edge_time)
+
+
+# Run all the queued GPIO actions in the order they happened. Returns whether there were any.
+def run_gpio_events(record_latency):
+    ran = False
+    while gpio_events:
+        edge_time, callback = gpio_events.popleft()
+        run_gpio_event(edge_time, callback, record_latency)
+        ran = True
+    return ran
+
+
+def perf_summary(label, name):
+    samples = sorted(perf_timings[name])
+    if not samples:
+        return f"{label}: -"
+    p50 = samples[len(samples) // 2] * 1000
+    p95 = samples[int(len(samples) * 0.95)] * 1000
+    return f"{label}: {p50:.1f} / {p95:.1f} / {samples[-1] * 1000:.1f} ms"
+
+
+def draw_debug_overlay():
+    global gpio_callbacks_seen, gpio_callbacks_seen_at
+    if last_scene is not None:
+        # The text is drawn over the scene, so put a clean copy of the scene back under it first.
+        scene_name = last_scene[0]
+        invalidate_scene()
+        render_scene(scene_name)
+    now = time.perf_counter()
+    gpio_rate = (gpio_callbacks - gpio_callbacks_seen) / (now - gpio_callbacks_seen_at)
+    gpio_callbacks_seen, gpio_callbacks_seen_at = gpio_callbacks, now
+    lines = [
+        f"SOLAR: {SOLAR}  WATER: {WATER}  WIND: {WIND}",
+        "p50 / p95 / max",
+        perf_summary("Input", "input"),
+        perf_summary("Frame", "frame"),
+        perf_summary("Workflow", "workflow"),
+        perf_summary("Video", "video"),
+        perf_summary("Events", "events"),
+        f"GPIO: {gpio_rate:.1f} callbacks/s, {edge_bounces()} bounces filtered",
+        f"Video quality: {pygame_movie.quality}, {pygame_movie.dropped} dropped",
+        sound_status(),
+        f"GPIO writes: {OUTPUTS.written} done, {OUTPUTS.skipped} skipped",
+    ]
+    for line_number, line in enumerate(lines):
+        dirty_rects.append(
+            draw_text(pygame_screen, line, 2000, 10 + line_number * 90, per_glyph=line_number > 1)
+        )
 
 
 # set global variables to track the state of the left and right stop sensors
@@ -188,115 +614,281 @@ def draw_turn_left_image():
     global pygame_screen, pygame_images
     turn_left_image = pygame_images["turnleft"]
     turn_left_rect = turn_left_image.get_rect(center=(1921 + 960, 540))
-    pygame_screen.blit(turn_left_image, turn_left_rect)
-    # pygame.display.flip()
+    dirty_rects.append(pygame_screen.blit(turn_left_image, turn_left_rect))
 
 
 def draw_turn_right_image():
     global pygame_screen, pygame_images
     turn_right_image = pygame_images["turnright"]
     turn_right_rect = turn_right_image.get_rect(center=(1921 + 960, 540))
-    pygame_screen.blit(turn_right_image, turn_right_rect)
-    # pygame.display.flip()
-
-
-water_started = datetime.datetime.now()
-wind_started = datetime.datetime.now()
-
-
-def workflow_engine():
-    global SOLAR, WATER, WIND, pygame_screen, pygame_images, pygame_sounds, water_started, wind_started
-
-    if SOLAR == 0 and WATER == 0 and WIND == 0:
-        HOUSE1.off()
-        HOUSE2.off()
-        HOUSE3.off()
-        HOUSE4.off()
-        pygame_screen.blit(pygame_images["sunset"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunsetcontrols"], (1921, 0))
-    elif SOLAR == 1 and WATER == 0 and WIND == 0:
-        HOUSE1.on()
-        HOUSE2.off()
-        HOUSE3.off()
-        HOUSE4.off()
-        pygame_screen.blit(pygame_images["sunshadebg"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunshade"], (1921, 0))
-    elif SOLAR == 2 and WATER == 0 and WIND == 0:
-        HOUSE1.on()
-        HOUSE2.on()
-        HOUSE3.on()
-        HOUSE4.on()
-        pygame_screen.blit(pygame_images["sunoutbg"], (1921, 0))
-        pygame_screen.blit(pygame_images["sunout"], (1921, 0))
-    elif WATER == 1:
-        if datetime.datetime.now() - water_started > datetime.timedelta(seconds=8):
-            WATER_MOTOR.on()
-            WATER = 0
-            pygame_sounds["hydro"].stop()
-        else:
-            HOUSE1.on()
-            HOUSE2.on()
-            HOUSE3.on()
-            HOUSE4.on()
-            pygame_screen.blit(pygame_images["hydrobg"], (1921, 0))
-            pygame_screen.blit(pygame_images["hydro"], (1921, 0))
-            WATER_MOTOR.off()
-            pygame_sounds["hydro"].play()
-    elif WIND == 1:
-        if datetime.datetime.now() - wind_started > datetime.timedelta(seconds=8):
-            WIND_MOTOR.on()
-            WIND = 0
-            pygame_sounds["wind"].stop()
-        else:
-            HOUSE1.on()
-            HOUSE2.on()
-            HOUSE3.on()
-            HOUSE4.on()
-            pygame_screen.blit(pygame_images["windbg"], (1921, 0))
-            pygame_screen.blit(pygame_images["wind"], (1921, 0))
-            WIND_MOTOR.off()
-            pygame_sounds["wind"].play()
-
-    # Check the state of the left and right stop sensors. As we need to redraw after each workflow run.
+    dirty_rects.append(pygame_screen.blit(turn_right_image, turn_right_rect))
+
+
+def render_scene(name):
+    """Draw the named scene on the right screen, skipping the work if it is already on screen."""
+    global last_scene
+    scene = (name, LEFT_STATE_CHANGED, RIGHT_STATE_CHANGED)
+    if scene == last_scene:
+        return
+    last_scene = scene
+    dirty_rects.append(pygame_screen.blit(pygame_scenes[name], RIGHT_SCREEN_POS))
+    # The turn images sit on top of the scene, so they are redrawn with it.
     if LEFT_STATE_CHANGED:
-        # draw the turn left image
         draw_turn_left_image()
     if RIGHT_STATE_CHANGED:
-        # draw the turn right image
         draw_turn_right_image()
 
 
-def sunout_action():
-    global SOLAR, stop_event
-    SOLAR = 2
-    stop_event.set()  # Signal the stop_event to stop any ongoing threads
-    pygame_sounds["night"].stop()
+def invalidate_scene():
+    """Force the right screen to be redrawn on the next workflow run."""
+    global last_scene, current_state
+    last_scene = None
+    current_state = None
 
 
-def sunset_action():
-    global SOLAR, pygame_screen, pygame_images, pygame_sounds, stop_event
+# How long the water and wind motors run after their button is pressed.
+MOTOR_RUN_SECONDS = 8
 
-    SOLAR = 0
+# Timers run on the main loop, in deadline order, on a monotonic clock so clock changes can't upset them.
+# Each timer is [deadline, sequence, callback]. Only the main loop schedules them (the GPIO threads only
+# queue raw edges), so they need no lock.
+timers = []
+timer_sequence = itertools.count()
+water_motor_timer = None
+wind_motor_timer = None
 
-    def play_night_sound():
-        while not stop_event.is_set():
-            print("Playing night sound...")
-            pygame_sounds["night"].play()
-            time.sleep(pygame_sounds["night"].get_length())
 
-    if (
-        not hasattr(sunset_action, "night_sound_thread")
-        or not sunset_action.night_sound_thread.is_alive()
-    ):
-        print("Starting night sound thread...")
-        stop_event.clear()
-        sunset_action.night_sound_thread = threading.Thread(
-            target=play_night_sound, daemon=True
-        )
-        sunset_action.night_sound_thread.start()
+def schedule(delay, callback):
+    timer = [time.monotonic() + delay, next(timer_sequence), callback]
+    heapq.heappush(timers, timer)
+    return timer
+
+
+# Cancelled timers stay on the heap and are dropped when they come due.
+def cancel(timer):
+    if timer is not None:
+        timer[2] = None
+
+
+def run_due_timers():
+    fired = False
+    now = time.monotonic()
+    while timers and timers[0][0] <= now:
+        callback = heapq.heappop(timers)[2]
+        if callback is not None:
+            callback()
+            fired = True
+    return fired
+
+
+# Seconds until the next timer is due, or None if there are none.
+def time_until_next_timer():
+    while timers and timers[0][2] is None:
+        heapq.heappop(timers)
+    if not timers:
+        return None
+    return max(0.0, timers[0][0] - time.monotonic())
+
+
+# The workflow engine stops the motor and its sound when it sees the state change.
+def stop_water_motor():
+    global WATER
+    WATER = 0
+
+
+def stop_wind_motor():
+    global WIND
+    WIND = 0
+
+
+# Sounds that loop while a state lasts. Each sound gets a mixer channel of its own, reserved so that
+# nothing else can take it, and is started once when its state begins rather than on every workflow run.
+SOUND_FADE_MS = 1000
+sound_channels = {}
+sounds_playing = set()
+
+
+def sound_channel(name):
+    if name not in sound_channels:
+        pygame.mixer.set_reserved(len(sound_channels) + 1)
+        sound_channels[name] = pygame.mixer.Channel(len(sound_channels))
+    return sound_channels[name]
+
+
+def start_sound(name, fade_ms=0):
+    if name in sounds_playing:
+        return
+    sounds_playing.add(name)
+    if isinstance(pygame_sounds[name], str):
+        start_stream(name, fade_ms)
+    else:
+        sound_channel(name).play(pygame_sounds[name], loops=-1, fade_ms=fade_ms)
+
+
+def stop_sound(name, fade_ms=SOUND_FADE_MS):
+    if name not in sounds_playing:
+        return
+    sounds_playing.discard(name)
+    if isinstance(pygame_sounds[name], str):
+        stop_stream(name, fade_ms)
     else:
-        print("Night sound thread is already running.")
+        sound_channel(name).fadeout(fade_ms)
+
+
+# Streamed sounds play through pygame.mixer.music, which reads and decodes the file a buffer at a time.
+# There is only one music stream, so a stream started while the last one fades out waits for it to finish.
+streaming = None
+stream_fade_end = 0.0
+stream_timer = None
+
+
+def start_stream(name, fade_ms):
+    global streaming, stream_timer
+    cancel(stream_timer)
+    # Whatever was streaming is cut off.
+    sounds_playing.discard(streaming)
+    streaming = name
+    wait = stream_fade_end - time.monotonic()
+    if wait > 0:
+        stream_timer = schedule(wait, lambda: play_stream(name, fade_ms))
+    else:
+        play_stream(name, fade_ms)
+
+
+def play_stream(name, fade_ms):
+    pygame.mixer.music.load(pygame_sounds[name])
+    pygame.mixer.music.set_volume(SOUND_VOLUME)
+    pygame.mixer.music.play(loops=-1, fade_ms=fade_ms)
+
+
+def stop_stream(name, fade_ms):
+    global streaming, stream_fade_end
+    if streaming != name:
+        return
+    cancel(stream_timer)
+    streaming = None
+    pygame.mixer.music.fadeout(fade_ms)
+    stream_fade_end = time.monotonic() + fade_ms / 1000
+
+
+# Ambient beds loop in the background of a scene, with an occasional one-off sound scheduled over them.
+# Changing bed crossfades from the old one to the new one, except that a streamed bed has to fade out
+# before the next streamed one can fade in.
+AMBIENT_FADE_MS = 3000
+AMBIENT_EXTRAS = {
+    "night": ("owl", 20, 60),  # Sound, and the shortest and longest wait in seconds between plays.
+}
+ambient_bed = None
+ambient_extra_timer = None
+
+
+def set_ambient(name):
+    global ambient_bed, ambient_extra_timer
+    if name == ambient_bed:
+        return
+    if ambient_bed is not None:
+        stop_sound(ambient_bed, AMBIENT_FADE_MS)
+    cancel(ambient_extra_timer)
+    ambient_extra_timer = None
+    ambient_bed = name
+    if name is not None:
+        print(f"Playing {name} sound...")
+        start_sound(name, AMBIENT_FADE_MS)
+        schedule_ambient_extra()
+
+
+def schedule_ambient_extra():
+    global ambient_extra_timer
+    if ambient_bed in AMBIENT_EXTRAS:
+        shortest, longest = AMBIENT_EXTRAS[ambient_bed][1:]
+        ambient_extra_timer = schedule(random.uniform(shortest, longest), play_ambient_extra)
+
+
+def play_ambient_extra():
+    if ambient_bed not in AMBIENT_EXTRAS:
+        return
+    extra = AMBIENT_EXTRAS[ambient_bed][0]
+    # Extras are short enough to be in memory. Streaming one would cut off a streamed bed.
+    if not isinstance(pygame_sounds[extra], str):
+        sound_channel(extra).play(pygame_sounds[extra])
+    schedule_ambient_extra()
+
+
+def sound_status():
+    if not pygame.mixer.get_init():
+        return "Audio: off"
+    frequency = pygame.mixer.get_init()[0]
+    total = pygame.mixer.get_num_channels()
+    busy = sum(pygame.mixer.Channel(index).get_busy() for index in range(total))
+    streams = int(pygame.mixer.music.get_busy())
+    return f"Audio: {busy}/{total} channels, {streams} stream, {(busy + streams) * frequency / 1000:.0f}k samples/s"
+
+
+# What the exhibit shows for each state. A state is (SOLAR, WATER, WIND, left stop sensor, right stop
+# sensor) and its record holds the output levels, the scene and the looping sounds for it. The table
+# is built once from the rules below, so adding a power source means adding a row, not a branch.
+StateRecord = collections.namedtuple("StateRecord", ["outputs", "scene", "sounds"])
+
+# SOLAR level: houses lit and scene, while no turbine is running.
+SOLAR_STATES = {0: (0, "sunset"), 1: (1, "sunshade"), 2: (len(HOUSES), "sunout")}
+# Turbines in the order they take over the screen: relay, scene and sound. A running turbine lights
+# every house. The relays are active low.
+TURBINES = (
+    ("water", "hydro", "hydro"),
+    ("wind", "wind", "wind"),
+)
+
+
+def build_state_table():
+    table = {}
+    for solar, *running, left, right in itertools.product(
+        SOLAR_STATES, *[(0, 1)] * len(TURBINES), (False, True), (False, True)
+    ):
+        lit, scene = SOLAR_STATES[solar]
+        outputs = {}
+        sounds = set()
+        for (relay, turbine_scene, sound), on in reversed(list(zip(TURBINES, running))):
+            outputs[relay] = 0 if on else 1
+            if on:
+                lit, scene = len(HOUSES), turbine_scene
+                sounds.add(sound)
+        outputs.update(house_lights(lit))
+        table[(solar, *running, left, right)] = StateRecord(outputs, scene, frozenset(sounds))
+    return table
+
+
+STATE_TABLE = build_state_table()
+STATE_SOUNDS = frozenset(sound for relay, scene, sound in TURBINES)
+current_state = None
+
+
+# Acts only when the state changes. invalidate_scene() forces the next run to redraw.
+def workflow_engine():
+    global current_state
+    state = (SOLAR, WATER, WIND, LEFT_STATE_CHANGED, RIGHT_STATE_CHANGED)
+    if state == current_state:
+        return
+    record = STATE_TABLE[state]
+    current_state = state
+    OUTPUTS.write(record.outputs)
+    render_scene(record.scene)
+    for sound in STATE_SOUNDS - record.sounds:
+        stop_sound(sound)
+    for sound in record.sounds:
+        start_sound(sound)
 
+
+def sunout_action():
+    global SOLAR
+    SOLAR = 2
+    set_ambient(None)
+
+
+def sunset_action():
+    global SOLAR
+    SOLAR = 0
+    # The mixer loops the night sound itself until the sun comes out.
+    set_ambient("night")
     sys.stdout.flush()
 
 
@@ -306,54 +898,98 @@ def sunshade_action():
 
 
 def hydro_action():
-    global WATER, water_started, pygame_movie
-    if pygame_movie.active == True:
+    global WATER, water_motor_timer, pygame_movie
+    if pygame_movie.active == False:
+        # The movie has finished, play it again from the prerolled start.
+        pygame_movie.restart()
+    elif pygame_movie.frame > 1000:
         # Only restart the threat if the movie is more than 8 seconds in
-        if pygame_movie.frame > 1000:
-            pygame_movie.restart()  # Restart the movie from the beginning
+        pygame_movie.restart()  # Restart the movie from the beginning
     WATER = 1
-    water_started = datetime.datetime.now()
+    # Pressing again while the motor runs starts the run window over.
+    cancel(water_motor_timer)
+    water_motor_timer = schedule(MOTOR_RUN_SECONDS, stop_water_motor)
 
 
 def wind_action():
-    global WIND, wind_started
+    global WIND, wind_motor_timer
     WIND = 1
-    wind_started = datetime.datetime.now()
+    cancel(wind_motor_timer)
+    wind_motor_timer = schedule(MOTOR_RUN_SECONDS, stop_wind_motor)
+
+
+# Block until there are events. With a timeout, returns an empty list if nothing happened in time.
+def wait_for_events(timeout=None):
+    if timeout is None:
+        event = pygame.event.wait()
+    else:
+        event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
 
 
 def main():
-    global pygame_screen, pygame_images, pygame_sounds, pygame_movie
+    global pygame_screen, pygame_images, pygame_scenes, pygame_sounds, pygame_movie
 
+    startup_step("Modules imported")
+    # Startup is staged so the screen shows something as soon as possible:
+    # 1. the display, and the start scene from the image cache,
+    # 2. the sensors, buttons and outputs,
+    # 3. sound and video, imported and opened on loader threads while the rest of the images load.
     pygame_screen = setup_pygame()
-    pygame_images = load_images()
-    pygame_sounds = load_sounds()
-    pygame_movies = load_movies()
+    with ThreadPoolExecutor(max_workers=ASSET_LOADER_WORKERS) as executor:
+        pygame_images = load_images(executor, SCENES["start"])
+        show_start_scene(pygame_images)
+        setup_gpio()
+        startup_step("GPIO ready")
+        sounds_future = executor.submit(load_sounds)
+        movies_future = executor.submit(load_movies)
+        pygame_images.update(load_images(executor, [name for name in IMAGES if name not in pygame_images]))
+        pygame_scenes = compose_scenes(pygame_images)
+        pygame_sounds = sounds_future.result()
+        pygame_movies = movies_future.result()
     pygame_movie = pygame_movies["hydro"]
+    startup_step("Sound and video ready")
     # if pygame_movie.active == False:
     # play_movie_thread(pygame_movie, pygame_screen, (0, 0))
 
-    SUNSET_BUTTON.when_pressed = sunset_action
-    SUNSET_BUTTON.when_released = sunout_action
-    SUNBEHIND_BUTTON.when_pressed = sunshade_action
-    SUNBEHIND_BUTTON.when_released = sunout_action
-    BUTTON1.when_pressed = hydro_action
-    BUTTON2.when_pressed = wind_action
-    LEFT_STOP_SENSOR.when_pressed = left_stop_sensor_pressed
-    LEFT_STOP_SENSOR.when_released = left_stop_sensor_released
-    RIGHT_STOP_SENSOR.when_pressed = right_stop_sensor_pressed
-    RIGHT_STOP_SENSOR.when_released = right_stop_sensor_released
+    # Record the input edges, or replay them from a trace, if asked to. See gpio_trace.py.
+    from gpio_trace import start_trace
+
+    gpio_recorder = start_trace()
 
     running = True
     debugOn = False
-    last_time = datetime.datetime.now()
+    run_workflow = True
+    last_workflow = time.perf_counter()
 
     while running:
-        if datetime.datetime.now() - last_time > datetime.timedelta(seconds=0.1):
-            last_time = datetime.datetime.now()
-            workflow_engine()
+        # Sleep until a GPIO callback or key press wakes us, or the next timer is due. Also wake
+        # regularly while the video plays or the debug overlay is up.
+        wake_after = [time_until_next_timer()]
+        if pygame_movie.active == True:
+            wake_after.append(VIDEO_WAKE_MS / 1000)
+        if debugOn:
+            wake_after.append(WORKFLOW_TICK_MS / 1000)
+        wake_after = [seconds for seconds in wake_after if seconds is not None]
+        if run_workflow:
+            events = pygame.event.get()
+        elif wake_after:
+            # pygame.event.wait(0) would wait forever, so never ask for less than 1 ms.
+            events = wait_for_events(max(1, math.ceil(min(wake_after) * 1000)))
+        else:
+            events = wait_for_events()
+
+        # Timestamps are cheap; they are only stored while the debug overlay is on. A frame is timed from
+        # waking up to the display update, so the time spent waiting isn't counted.
+        loop_start = time.perf_counter()
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+        for event in events:
+            if event.type == GPIO_EVENT:
+                # Only wakes the loop, the queued actions are run below.
+                pass
+            elif event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_h:
@@ -368,6 +1004,10 @@ def main():
                     # Code to handle "d" key press event
                     # Hide the screen so that I can see the console
                     debugOn = not debugOn
+                    invalidate_scene()
+                    run_workflow = True
+                    for samples in perf_timings.values():
+                        samples.clear()
                 if event.key == pygame.K_q:
                     # Code to handle "q" key press event
                     # Hide the screen so that I can see the console
@@ -375,20 +1015,46 @@ def main():
                 if event.key == pygame.K_s:
                     # Code to handle "s" key press event
                     # Stop playing the crickets sound.
-                    pygame_sounds["night"].stop()
-
-        if pygame_movie.active == True:
-            pygame_movie.draw(pygame_screen, (0, 0), force_draw=False)
+                    set_ambient(None)
 
+        events_end = time.perf_counter()
         if debugOn:
-            draw_text(pygame_screen, "SOLAR: " + str(SOLAR), 2000, 10)
-            draw_text(pygame_screen, "WATER: " + str(WATER), 2000, 100)
-            draw_text(pygame_screen, "WIND: " + str(WIND), 2000, 200)
+            perf_timings["events"].append(events_end - loop_start)
+
+        # Raw edges and timers first, the edge filters' checks can queue GPIO actions.
+        run_raw_edges()
+        if run_due_timers():
+            run_workflow = True
+        if run_gpio_events(debugOn):
+            run_workflow = True
+        if debugOn and events_end - last_workflow >= WORKFLOW_TICK_MS / 1000:
+            run_workflow = True
+        if run_workflow:
+            run_workflow = False
+            last_workflow = events_end
+            workflow_start = time.perf_counter()
+            workflow_engine()
+            if debugOn:
+                perf_timings["workflow"].append(time.perf_counter() - workflow_start)
+                draw_debug_overlay()
 
-        pygame.display.update()
-        time.sleep(0.01)  # Small delay to prevent CPU overuse
-        # pygame.time.wait(15)
+        video_start = time.perf_counter()
+        if pygame_movie.active == True:
+            if pygame_movie.draw(pygame_screen, (0, 0), force_draw=False):
+                dirty_rects.append(LEFT_SCREEN_RECT)
+            if debugOn:
+                perf_timings["video"].append(time.perf_counter() - video_start)
+
+        # Only push the areas that changed to the monitors.
+        if dirty_rects:
+            pygame.display.update(dirty_rects)
+            dirty_rects.clear()
+        if debugOn:
+            perf_timings["frame"].append(time.perf_counter() - loop_start)
     pygame_movie.stop()
+    pygame_movie.close()
+    if gpio_recorder is not None:
+        gpio_recorder.close()
     pygame.quit()
     sys.exit()
 
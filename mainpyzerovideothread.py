@@ -4,11 +4,12 @@ import time
 import datetime
 import sys
 import os
-import threading
-from gpiozero import Button, LED, OutputDevice
+from gpiozero import Button
 import pygame
 from pygame.locals import *
-from pyvidplayer2 import Video
+from videoplayer import ThreadedVideo
+from gpio_backend import house_lights, open_outputs
+from scenes import convert_image
 
 # Constants
 PI_HIGH = 1
@@ -25,34 +26,22 @@ SUNBEHIND_BUTTON = Button(21)
 BUTTON1 = Button(19)
 BUTTON2 = Button(26)
 
-# LEDs for houses
-HOUSE1 = LED(1)
-HOUSE2 = LED(7)
-HOUSE3 = LED(8)
-HOUSE4 = LED(25)
+# LEDs for houses, and the relays for the Water and Wind Turbine motors (active low, so start stopped).
+OUTPUTS = open_outputs(
+    {"house1": 1, "house2": 7, "house3": 8, "house4": 25, "water": 2, "wind": 3},
+    initial={"water": 1, "wind": 1},
+    default_backend="gpiozero",
+)
 
-# Output devices for motors
-WATER_MOTOR = OutputDevice(2, initial_value=True)  # Water Turbine motor
-WIND_MOTOR = OutputDevice(3, initial_value=True)  # Wind Turbine motor
+# The video plays on the left monitor.
+LEFT_SCREEN_RECT = pygame.Rect(0, 0, 1920, 1080)
+# Frames from the start of each movie kept decoded so a button press shows the movie straight away.
+VIDEO_PREROLL_FRAMES = 10
 
-# Shared variables for thread control
-stop_event = threading.Event()
-video_playing = False
-
-
-def play_movie(movie, screen, position=(0, 0)):
-    """
-    Play the specified movie in a separate thread.
-    """
-    global video_playing
-    video_playing = True
-    movie.restart()  # Restart the movie from the beginning
-    while movie.active and not stop_event.is_set():
-        if movie.draw(screen, position, force_draw=False):
-            pygame.display.update()
-        time.sleep(0.01)  # Small delay to prevent CPU overuse
-    movie.stop()
-    video_playing = False
+# Posted by the GPIO callbacks to wake the main loop.
+GPIO_EVENT = pygame.event.custom_type()
+# How often the loop wakes to draw the video while it plays.
+VIDEO_WAKE_MS = 10
 
 
 def load_images():
@@ -75,8 +64,15 @@ def load_images():
     loaded_images = {}
     for name, image_path in images.items():
         try:
+            decode_start = time.perf_counter()
             loaded_image = pygame.image.load(image_path)
-            loaded_images[name] = loaded_image
+            convert_start = time.perf_counter()
+            loaded_images[name] = convert_image(loaded_image)
+            convert_end = time.perf_counter()
+            print(
+                f"Image {image_path} decode {(convert_start - decode_start) * 1000:.0f} ms, "
+                f"convert {(convert_end - convert_start) * 1000:.0f} ms"
+            )
         except pygame.error:
             print(f"Failed to load image: {image_path}")
     return loaded_images
@@ -89,7 +85,8 @@ def load_movies():
     loaded_movies = {}
     for name, movie_path in movies.items():
         try:
-            loaded_movie = Video(movie_path)
+            # Decoding runs on the video's own thread, drawing stays on the main thread.
+            loaded_movie = ThreadedVideo(movie_path, preroll=VIDEO_PREROLL_FRAMES)
             loaded_movie.mute()
             loaded_movies[name] = loaded_movie
         except Exception as e:
@@ -138,26 +135,17 @@ def workflow_engine():
     global SOLAR, WATER, WIND, pygame_screen, pygame_images, pygame_sounds, water_started, wind_started
 
     if SOLAR == 0 and WATER == 0 and WIND == 0:
-        HOUSE1.off()
-        HOUSE2.off()
-        HOUSE3.off()
-        HOUSE4.off()
+        OUTPUTS.write(house_lights(0))
         pygame_screen.blit(pygame_images["sunset"], (1921, 0))
         pygame_screen.blit(pygame_images["sunsetcontrols"], (1921, 0))
         pygame.display.update()
     elif SOLAR == 1 and WATER == 0 and WIND == 0:
-        HOUSE1.on()
-        HOUSE2.off()
-        HOUSE3.off()
-        HOUSE4.off()
+        OUTPUTS.write(house_lights(1))
         pygame_screen.blit(pygame_images["sunshadebg"], (1921, 0))
         pygame_screen.blit(pygame_images["sunshade"], (1921, 0))
         pygame.display.update()
     elif SOLAR == 2 and WATER == 0 and WIND == 0:
-        HOUSE1.on()
-        HOUSE2.on()
-        HOUSE3.on()
-        HOUSE4.on()
+        OUTPUTS.write(house_lights(4))
         pygame_screen.blit(pygame_images["sunoutbg"], (1921, 0))
         pygame_screen.blit(pygame_images["sunout"], (1921, 0))
         pygame.display.update()
@@ -174,10 +162,9 @@ def sunshade_action():
 
 
 def hydro_action():
-    global WATER, water_started, pygame_screen, pygame_movies
-    global video_playing
-    if not video_playing:
-        play_movie_thread(pygame_movies["hydro"], pygame_screen, (0, 0))
+    global WATER, water_started, pygame_movies
+    if not pygame_movies["hydro"].active:
+        pygame_movies["hydro"].restart()
     WATER = 1
     water_started = datetime.datetime.now()
 
@@ -188,10 +175,28 @@ def wind_action():
     wind_started = datetime.datetime.now()
 
 
-def play_movie_thread(movie, screen, position=(0, 0)):
-    # Create a separate thread for movie playback
-    movie_thread = threading.Thread(target=play_movie, args=(movie, screen, position))
-    movie_thread.start()
+# Wrap a GPIO callback so it wakes the main loop once it has run.
+def gpio_callback(callback):
+    def wake_main_loop():
+        callback()
+        try:
+            pygame.event.post(pygame.event.Event(GPIO_EVENT))
+        except pygame.error:
+            # An edge after pygame has shut down.
+            pass
+
+    return wake_main_loop
+
+
+# Block until there are events. With a timeout, returns an empty list if nothing happened in time.
+def wait_for_events(timeout=None):
+    if timeout is None:
+        event = pygame.event.wait()
+    else:
+        event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
 
 
 def main():
@@ -200,27 +205,42 @@ def main():
     pygame_screen = setup_pygame()
     pygame_images = load_images()
     pygame_movies = load_movies()
+    # Only play the video when the hydro button is pressed.
+    pygame_movies["hydro"].stop()
 
-    SUNSET_BUTTON.when_pressed = sunrise_sunset_action
-    SUNBEHIND_BUTTON.when_pressed = sunshade_action
-    BUTTON1.when_pressed = hydro_action
-    BUTTON2.when_pressed = wind_action
+    SUNSET_BUTTON.when_pressed = gpio_callback(sunrise_sunset_action)
+    SUNBEHIND_BUTTON.when_pressed = gpio_callback(sunshade_action)
+    BUTTON1.when_pressed = gpio_callback(hydro_action)
+    BUTTON2.when_pressed = gpio_callback(wind_action)
 
     running = True
-    last_time = datetime.datetime.now()
+    run_workflow = True
 
     while running:
-        if datetime.datetime.now() - last_time > datetime.timedelta(seconds=0.1):
-            last_time = datetime.datetime.now()
-            workflow_engine()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT or event.type == pygame.KEYDOWN:
+        # Sleep until a GPIO callback or key press wakes us. Only wake on a timeout while the video plays.
+        if run_workflow:
+            events = pygame.event.get()
+        elif pygame_movies["hydro"].active:
+            events = wait_for_events(VIDEO_WAKE_MS)
+        else:
+            events = wait_for_events()
+
+        for event in events:
+            if event.type == GPIO_EVENT:
+                run_workflow = True
+            elif event.type == pygame.QUIT or event.type == pygame.KEYDOWN:
                 running = False
 
-        pygame.time.wait(15)
+        # The state only changes in the GPIO callbacks, so the workflow only needs to run after one.
+        if run_workflow:
+            run_workflow = False
+            workflow_engine()
+
+        if pygame_movies["hydro"].active:
+            if pygame_movies["hydro"].draw(pygame_screen, (0, 0), force_draw=False):
+                pygame.display.update(LEFT_SCREEN_RECT)
 
-    stop_event.set()  # Stop the video playback thread
+    pygame_movies["hydro"].close()
     pygame.quit()
     sys.exit()
 
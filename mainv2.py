@@ -24,55 +24,37 @@
 # The motors will run for 10 seconds and then stop
 #!/usr/bin/env python3
 
-import gpiod
+import math
+import select
+import threading
 import time
-import datetime
 import sys
 import os
 import pygame
 from pygame.locals import *
 from pyvidplayer2 import Video
-
-# GPIO setup using libgpiod
-chip = gpiod.Chip("gpiochip0")  # Adjust if using a different gpiochip
-
-# Define the lines for each GPIO pin used
-LINES = {
-    "sunset": chip.get_line(20),
-    "sunbehind": chip.get_line(21),
-    "button1": chip.get_line(19),
-    "button2": chip.get_line(26),
-    "house1": chip.get_line(1),
-    "house2": chip.get_line(7),
-    "house3": chip.get_line(8),
-    "house4": chip.get_line(25),
-    "water": chip.get_line(2),
-    "wind": chip.get_line(3),
+from gpio_backend import GpiodInputs, house_lights, open_outputs
+from edge_filter import EdgeFilter, EdgeRule
+
+# The inputs are requested for edge events on both edges, with the pull-ups on. A thread sleeps on
+# their file descriptors and only wakes when one of them changes.
+INPUTS = GpiodInputs({"sunset": 20, "sunbehind": 21, "button1": 19, "button2": 26})
+
+# Debounce rules, see edge_filter.py. The sun sensors hold a change for half a second so they can't flap.
+EDGE_RULES = {
+    "sunset": EdgeRule(stable=0.05, hysteresis=0.5, samples=2),
+    "sunbehind": EdgeRule(stable=0.05, hysteresis=0.5, samples=2),
+    "button1": EdgeRule(stable=0.01, hysteresis=0.0, samples=1),
+    "button2": EdgeRule(stable=0.01, hysteresis=0.0, samples=1),
 }
 
-# Request the lines with appropriate settings
-LINES["sunset"].request(
-    consumer="sunset",
-    type=gpiod.LINE_REQ_DIR_IN,
-    flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP,
-)
-LINES["sunbehind"].request(
-    consumer="sunbehind",
-    type=gpiod.LINE_REQ_DIR_IN,
-    flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP,
-)
-LINES["button1"].request(
-    consumer="button1",
-    type=gpiod.LINE_REQ_DIR_IN,
-    flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP,
+# Posted to pygame with the input's name and new level once a change gets through its filter.
+GPIO_EVENT = pygame.USEREVENT + 1
+# The outputs are requested together, so they are all set with one bulk call.
+OUTPUTS = open_outputs(
+    {"house1": 1, "house2": 7, "house3": 8, "house4": 25, "water": 2, "wind": 3},
+    default_backend="gpiod",
 )
-LINES["button2"].request(
-    consumer="button2",
-    type=gpiod.LINE_REQ_DIR_IN,
-    flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_UP,
-)
-for house in ["house1", "house2", "house3", "house4", "water", "wind"]:
-    LINES[house].request(consumer=house, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[0])
 
 PI_HIGH = 1
 PI_LOW = 0
@@ -82,6 +64,11 @@ SOLAR = 0  # 0 = No Sun, 1 = LOW Sunlight, 2 = Full Sun
 WATER = 0  # 0 = No Water, 1 = LOW Water, 2 = Full Water
 WIND = 0  # 0 = No Wind, 1 = LOW Wind, 2 = Full Wind
 
+# How long the motors run for, and when they were started on time.monotonic(), which the clock being
+# set doesn't move.
+MOTOR_RUN_SECONDS = 8
+water_started = wind_started = 0.0
+
 # Pygame setup functions here...
 
 
@@ -90,48 +77,40 @@ def workflow_engine():
 
     if SOLAR == 0 and WATER == 0 and WIND == 0:
         # Turn all house lights OFF
-        for house in ["house1", "house2", "house3", "house4"]:
-            LINES[house].set_value(PI_LOW)
+        OUTPUTS.write(house_lights(0))
     elif SOLAR == 1 and WATER == 0 and WIND == 0:
         # Half Power - Turn 3 houses lights OFF
-        LINES["house1"].set_value(PI_HIGH)
-        for house in ["house2", "house3", "house4"]:
-            LINES[house].set_value(PI_LOW)
+        OUTPUTS.write(house_lights(1))
     elif SOLAR == 2 and WATER == 0 and WIND == 0:
         # Full Sun - Turn all houses lights ON
-        for house in ["house1", "house2", "house3", "house4"]:
-            LINES[house].set_value(PI_HIGH)
+        OUTPUTS.write(house_lights(4))
     elif WATER == 1:
-        if datetime.datetime.now() - water_started > datetime.timedelta(seconds=8):
-            LINES["water"].set_value(PI_HIGH)
+        if time.monotonic() - water_started > MOTOR_RUN_SECONDS:
+            OUTPUTS.write({"water": PI_HIGH})
             WATER = 0
         else:
             # Hydro Power - Turn 2 houses lights ON
-            for house in ["house1", "house2", "house3", "house4"]:
-                LINES[house].set_value(PI_HIGH)
-            LINES["water"].set_value(PI_LOW)
+            OUTPUTS.write({**house_lights(4), "water": PI_LOW})
     elif WIND == 1:
-        if datetime.datetime.now() - wind_started > datetime.timedelta(seconds=8):
-            LINES["wind"].set_value(PI_HIGH)
+        if time.monotonic() - wind_started > MOTOR_RUN_SECONDS:
+            OUTPUTS.write({"wind": PI_HIGH})
             WIND = 0
         else:
             # Wind Power - Turn 1 house lights ON
-            for house in ["house1", "house2", "house3", "house4"]:
-                LINES[house].set_value(PI_HIGH)
-            LINES["wind"].set_value(PI_LOW)
+            OUTPUTS.write({**house_lights(4), "wind": PI_LOW})
 
 
-def sunrise_sunset_action():
+def sunrise_sunset_action(level):
     global SOLAR
-    if LINES["sunset"].get_value() == PI_LOW:
+    if level == PI_LOW:
         SOLAR = 0
     else:
         SOLAR = 2
 
 
-def sunshade_action():
+def sunshade_action(level):
     global SOLAR
-    if LINES["sunbehind"].get_value() == PI_LOW:
+    if level == PI_LOW:
         SOLAR = 1
     else:
         SOLAR = 2
@@ -140,13 +119,76 @@ def sunshade_action():
 def hydro_action():
     global WATER, water_started
     WATER = 1
-    water_started = datetime.datetime.now()
+    water_started = time.monotonic()
 
 
 def wind_action():
     global WIND, wind_started
     WIND = 1
-    wind_started = datetime.datetime.now()
+    wind_started = time.monotonic()
+
+
+# The buttons start their motor when pressed, so holding one down doesn't keep restarting it.
+def button1_action(level):
+    if level == PI_LOW:
+        hydro_action()
+
+
+def button2_action(level):
+    if level == PI_LOW:
+        wind_action()
+
+
+INPUT_ACTIONS = {
+    "sunset": sunrise_sunset_action,
+    "sunbehind": sunshade_action,
+    "button1": button1_action,
+    "button2": button2_action,
+}
+
+
+# Runs on its own thread. Sleeps in poll until an edge comes in or a filter is due a check, and posts
+# the changes that get through to the main loop.
+def watch_inputs():
+    now = time.monotonic()
+    filters = {name: EdgeFilter(rule, INPUTS.level(name), now) for name, rule in EDGE_RULES.items()}
+    poller = select.poll()
+    for fd in INPUTS.filenos():
+        poller.register(fd, select.POLLIN)
+
+    while True:
+        due = [edge_filter.due_time() for edge_filter in filters.values()]
+        due = [due_time for due_time in due if due_time is not None]
+        timeout = None
+        if due:
+            timeout = max(0, math.ceil((min(due) - time.monotonic()) * 1000))
+        for fd, mask in poller.poll(timeout):
+            for name, level, edge_time in INPUTS.read_edges(fd):
+                filters[name].edge(edge_time, level)
+
+        now = time.monotonic()
+        for name, edge_filter in filters.items():
+            due_time = edge_filter.due_time()
+            if due_time is not None and due_time <= now and edge_filter.check(now, INPUTS.level(name)):
+                try:
+                    pygame.event.post(pygame.event.Event(GPIO_EVENT, name=name, level=edge_filter.level))
+                except pygame.error:
+                    # An edge after pygame has shut down.
+                    pass
+
+
+# Milliseconds until a running motor is due to stop, or None if neither is running.
+def motor_timeout():
+    started = []
+    if WATER == 1:
+        started.append(water_started)
+    if WIND == 1:
+        started.append(wind_started)
+    if not started:
+        return None
+    left = min(started) + MOTOR_RUN_SECONDS - time.monotonic()
+    # pygame.event.wait(0) would wait forever, so never ask for less than 1 ms.
+    return max(1, math.ceil(left * 1000))
 
 
 def main():
@@ -157,31 +199,42 @@ def main():
     pygame_images = load_images()
     pygame_sounds = load_sounds()
 
+    # Start from the levels the sun sensors are at now.
+    sunrise_sunset_action(INPUTS.level("sunset"))
+    if SOLAR:
+        sunshade_action(INPUTS.level("sunbehind"))
+    threading.Thread(target=watch_inputs, name="gpio inputs", daemon=True).start()
+
     running = True
-    last_time = datetime.datetime.now()
+    workflow_engine()
 
     while running:
-        for event in pygame.event.get():
+        # Sleep until an input changes, a key is pressed or a motor is due to stop.
+        timeout = motor_timeout()
+        if timeout is None:
+            events = [pygame.event.wait()]
+        else:
+            events = [pygame.event.wait(timeout)]
+        events += pygame.event.get()
+
+        for event in events:
             if (
                 event.type == pygame.QUIT
                 or event.type == pygame.KEYDOWN
                 and event.key == pygame.K_s
             ):
                 running = False
-
-        # Check button states
-        if LINES["button1"].get_value() == PI_LOW:
-            hydro_action()
-        if LINES["button2"].get_value() == PI_LOW:
-            wind_action()
-
-        # Workflow engine to update display based on state
-        if datetime.datetime.now() - last_time > datetime.timedelta(seconds=0.1):
-            last_time = datetime.datetime.now()
+            elif event.type == GPIO_EVENT:
+                INPUT_ACTIONS[event.name](event.level)
+
+        # Workflow engine to update display based on state. A motor stopping changes the state, so run
+        # it again to set the lights for the new one.
+        state = (SOLAR, WATER, WIND)
+        workflow_engine()
+        if (SOLAR, WATER, WIND) != state:
             workflow_engine()
 
-        pygame.time.wait(15)
-
+    INPUTS.close()
     pygame.quit()
     sys.exit()
 
@@ -0,0 +1,42 @@
+# The right screen's scenes and the image helpers shared by the entry points.
+
+import pygame
+
+# Each scene on the right screen is a background with an overlay drawn on top.
+SCENES = {
+    "start": ("startbg", "start"),
+    "sunset": ("sunset", "sunsetcontrols"),
+    "sunshade": ("sunshadebg", "sunshade"),
+    "sunout": ("sunoutbg", "sunout"),
+    "hydro": ("hydrobg", "hydro"),
+    "wind": ("windbg", "wind"),
+}
+
+
+# Convert an image to the display pixel format so blits don't have to convert it every frame.
+# Only images that really have see-through pixels keep their alpha channel.
+def convert_image(image):
+    if image.get_flags() & pygame.SRCALPHA:
+        width, height = image.get_size()
+        if pygame.mask.from_surface(image, 254).count() < width * height:
+            return image.convert_alpha()
+    return image.convert()
+
+
+# Flatten each scene into one opaque surface so showing it is a single blit with no alpha blending.
+def compose_scenes(loaded_images):
+    composed_scenes = {}
+    for name, layers in SCENES.items():
+        if not all(layer in loaded_images for layer in layers):
+            print(f"Scene {name} is missing images, not composing it")
+            continue
+        composed_scenes[name] = compose_scene(layers, loaded_images)
+    return composed_scenes
+
+
+def compose_scene(layers, loaded_images):
+    background, overlay = (loaded_images[layer] for layer in layers)
+    scene = pygame.Surface(background.get_size())
+    scene.blit(background, (0, 0))
+    scene.blit(overlay, (0, 0))
+    return scene
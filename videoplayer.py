@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+
+# Video playback with decoding on a background thread.
+#
+# pyvidplayer2's Video decodes inside draw(), so a slow frame holds up the whole main loop. ThreadedVideo
+# decodes with OpenCV on its own thread into a small ring of preallocated frame buffers. The main loop
+# only blits the newest frame that is due. When the decoder falls behind it skips frames to catch up,
+# and when the main loop falls behind the stale frames are dropped, so neither side ever waits on the other.
+#
+# Frames come either from OpenCV decoding the movie, or from a frame store: the movie decoded once ahead
+# of time into a file that is memory mapped at playback, so no codec runs while the exhibit plays and
+# restarting is instant. Build one with:
+#   ./videoplayer.py build images/howdoeshydropowerwork1080p.mp4 [--format bgr|i420|jpeg]
+# bgr frames are copied straight into the ring. i420 frames take half the disk space and need a colour
+# conversion per frame. Either way the store is large: a 1080p frame is 6.2 MB as bgr, 3.1 MB as i420,
+# so the whole store rarely fits in memory and frames are read from the SD card as they play. jpeg frames
+# are each compressed on their own, to a few hundred KB at 1080p, and need a JPEG decode per frame. That
+# is still much cheaper than the movie's codec, and the store can stay in memory.
+#
+# When the Pi is too busy to keep up, playback steps down a quality level: to a pre-encoded low resolution
+# copy of the movie if there is one (scaled back up to full size on the decode thread, and only when the
+# movie is being decoded rather than played from a frame store), then to decoding every other frame. It
+# steps back up once there is headroom again.
+#
+# With preroll, the first few frames are kept decoded in memory and the decoder waits just past them
+# between plays. A restart shows frame 0 on the next draw, while the decoder carries on from there.
+
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+
+import cv2
+import numpy
+import pygame
+
+# Header: magic, width, height, fps, frame count, pixel format, source movie mtime (ns) and size.
+FRAME_STORE_HEADER = struct.Struct("<4sIIdIBqq")
+FRAME_STORE_MAGIC = b"FRM1"
+FRAME_STORE_FORMATS = {"bgr": 0, "i420": 1, "jpeg": 2}
+FRAME_STORE_JPEG_QUALITY = 90
+
+# Quality is judged over windows of this many seconds. Step down when decoding takes more than
+# ADAPT_DOWN_LOAD of the frame time or frames are dropped, and up after ADAPT_UP_WINDOWS windows in a
+# row under ADAPT_UP_LOAD. No change for ADAPT_COOLDOWN seconds after the last one.
+ADAPT_WINDOW = 1.0
+ADAPT_DOWN_LOAD = 0.9
+ADAPT_DOWN_DROPPED = 2
+ADAPT_UP_LOAD = 0.4
+ADAPT_UP_WINDOWS = 5
+ADAPT_COOLDOWN = 3.0
+
+
+def frame_store_path(movie_path):
+    return movie_path + ".frames"
+
+
+def frame_size(width, height, pixel_format):
+    if pixel_format == FRAME_STORE_FORMATS["i420"]:
+        return width * height * 3 // 2
+    return width * height * 3
+
+
+# Memory the kernel says is available, page cache included, or None where it can't be told.
+def available_memory():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class CaptureFrames:
+    """Frames decoded from the movie file by OpenCV."""
+
+    def __init__(self, path):
+        self._capture = cv2.VideoCapture(path)
+        if not self._capture.isOpened():
+            raise IOError(f"Could not open video {path}")
+        self.fps = self._capture.get(cv2.CAP_PROP_FPS) or 30
+        self.frame_count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.size = (
+            int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
+
+    def seek(self, frame):
+        self._capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+
+    # Move past a frame without converting it.
+    def skip(self):
+        return self._capture.grab()
+
+    # Decode the next frame into buffer. OpenCV releases the GIL while it works.
+    def read(self, buffer):
+        decoded, _ = self._capture.read(buffer)
+        return decoded
+
+    def close(self):
+        self._capture.release()
+
+
+class FrameStore:
+    """Frames read from a memory-mapped frame store written by build_frame_store()."""
+
+    def __init__(self, store_path, movie_path):
+        with open(store_path, "rb") as store_file:
+            self._map = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height, self.fps, self.frame_count, self._format, mtime_ns, size = (
+            FRAME_STORE_HEADER.unpack_from(self._map)
+        )
+        movie = os.stat(movie_path)
+        up_to_date = magic == FRAME_STORE_MAGIC and (mtime_ns, size) == (movie.st_mtime_ns, movie.st_size)
+        if up_to_date:
+            self._offsets, frames_end = self._frame_offsets(width, height)
+            up_to_date = frames_end == FRAME_STORE_HEADER.size + self._offsets[-1]
+        if not up_to_date:
+            self._map.close()
+            raise ValueError(f"Frame store {store_path} is out of date, rebuild it")
+        available = available_memory()
+        if available is not None and len(self._map) > available:
+            print(
+                f"Frame store {store_path} is {len(self._map) / 1024**3:.1f} GB, more than the "
+                f"{available / 1024**3:.1f} GB of memory available, so frames will be read from disk as they play"
+                + ("" if self._format == FRAME_STORE_FORMATS["jpeg"] else ". Rebuild it with --format jpeg")
+            )
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self.size = (width, height)
+        self._frames = memoryview(self._map)[FRAME_STORE_HEADER.size :]
+        self._position = 0
+
+    # Where each frame starts in the frames, plus where the last one ends, and where the frames end in
+    # the file. Raw frames are all the same size. Compressed frames vary, so their offsets are stored in
+    # an index after the frames.
+    def _frame_offsets(self, width, height):
+        if self._format != FRAME_STORE_FORMATS["jpeg"]:
+            offsets = numpy.arange(self.frame_count + 1, dtype=numpy.int64) * frame_size(width, height, self._format)
+            return offsets, len(self._map)
+        index_start = len(self._map) - (self.frame_count + 1) * 8
+        if index_start < FRAME_STORE_HEADER.size:
+            return numpy.zeros(1, numpy.int64), None
+        return numpy.frombuffer(self._map[index_start:], "<u8").astype(numpy.int64), index_start
+
+    def seek(self, frame):
+        self._position = frame
+
+    def skip(self):
+        if self._position >= self.frame_count:
+            return False
+        self._position += 1
+        return True
+
+    def read(self, buffer):
+        if self._position >= self.frame_count:
+            return False
+        start, end = self._offsets[self._position : self._position + 2]
+        pixels = numpy.frombuffer(self._frames[start:end], numpy.uint8)
+        width, height = self.size
+        if self._format == FRAME_STORE_FORMATS["jpeg"]:
+            # OpenCV releases the GIL while it decodes.
+            numpy.copyto(buffer, cv2.imdecode(pixels, cv2.IMREAD_COLOR))
+        elif self._format == FRAME_STORE_FORMATS["i420"]:
+            cv2.cvtColor(pixels.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420, dst=buffer)
+        else:
+            numpy.copyto(buffer, pixels.reshape(height, width, 3))
+        self._position += 1
+        return True
+
+    def close(self):
+        self._frames.release()
+        self._map.close()
+
+
+# Use the movie's frame store if one has been built and is up to date, otherwise decode the movie.
+def open_frames(movie_path, use_frame_store=True):
+    store_path = frame_store_path(movie_path)
+    if use_frame_store and os.path.exists(store_path):
+        try:
+            frames = FrameStore(store_path, movie_path)
+            print(f"Playing {movie_path} from frame store {store_path}")
+            return frames
+        except (OSError, ValueError, struct.error) as e:
+            print(e)
+    return CaptureFrames(movie_path)
+
+
+# Decode a movie once into a frame store next to it. Written to a temporary file first.
+def build_frame_store(movie_path, pixel_format="i420"):
+    capture = CaptureFrames(movie_path)
+    width, height = capture.size
+    format_code = FRAME_STORE_FORMATS[pixel_format]
+    movie = os.stat(movie_path)
+    store_path = frame_store_path(movie_path)
+    buffer = numpy.empty((height, width, 3), numpy.uint8)
+    frame_count = 0
+    offsets = [0]
+    with open(store_path + ".tmp", "wb") as store_file:
+        # The frame count is filled in once all the frames are written.
+        store_file.write(bytes(FRAME_STORE_HEADER.size))
+        while capture.read(buffer):
+            if format_code == FRAME_STORE_FORMATS["jpeg"]:
+                _, encoded = cv2.imencode(".jpg", buffer, [cv2.IMWRITE_JPEG_QUALITY, FRAME_STORE_JPEG_QUALITY])
+                frame = encoded.tobytes()
+            elif format_code == FRAME_STORE_FORMATS["i420"]:
+                frame = cv2.cvtColor(buffer, cv2.COLOR_BGR2YUV_I420).tobytes()
+            else:
+                frame = buffer.tobytes()
+            store_file.write(frame)
+            offsets.append(offsets[-1] + len(frame))
+            frame_count += 1
+            if frame_count % 100 == 0:
+                print(f"{frame_count} frames written")
+        if format_code == FRAME_STORE_FORMATS["jpeg"]:
+            store_file.write(numpy.array(offsets, "<u8").tobytes())
+        store_file.seek(0)
+        store_file.write(
+            FRAME_STORE_HEADER.pack(
+                FRAME_STORE_MAGIC,
+                width,
+                height,
+                capture.fps,
+                frame_count,
+                format_code,
+                movie.st_mtime_ns,
+                movie.st_size,
+            )
+        )
+    capture.close()
+    os.replace(store_path + ".tmp", store_path)
+    print(f"Wrote {frame_count} frames to {store_path}, {offsets[-1] / 1024**2:.0f} MB")
+    return store_path
+
+
+class ThreadedVideo:
+    """Drop-in for the parts of pyvidplayer2's Video the exhibit uses: active, frame, draw(),
+    play(), restart(), stop(), mute() and close().
+
+    All drawing happens on the calling thread. Only decoding runs on the worker thread.
+    low_quality_path is an optional lower resolution encode of the same movie, used under load.
+    preroll is how many frames from the start to keep decoded for an instant restart.
+    """
+
+    def __init__(self, path, ring_size=4, use_frame_store=True, low_quality_path=None, preroll=0):
+        self.path = path
+        self._frames = open_frames(path, use_frame_store)
+        self.fps = self._frames.fps
+        self.frame_count = self._frames.frame_count
+        width, height = self._frames.size
+        self.original_size = self.current_size = (width, height)
+
+        # Quality levels, best first: (name, frame source, frames advanced per decoded frame).
+        # The frame sources are opened the first time they are needed.
+        self._use_frame_store = use_frame_store
+        self._sources = [self._frames]
+        self._source_paths = [path]
+        self._scratch = [None]
+        self._levels = [("full", 0, 1)]
+        # Decoding the low resolution movie costs more than copying frames out of a frame store, so it is
+        # only a step down from decoding the full movie.
+        if (
+            low_quality_path
+            and low_quality_path != path
+            and os.path.exists(low_quality_path)
+            and not isinstance(self._frames, FrameStore)
+        ):
+            self._sources.append(None)
+            self._source_paths.append(low_quality_path)
+            self._scratch.append(None)
+            self._levels.append(("low resolution", 1, 1))
+        self._levels.append(("half frame rate", len(self._sources) - 1, 2))
+        self._level = 0
+        self.quality = self._levels[0][0]
+        self._source_index = 0
+        self._window_start = time.monotonic()
+        self._window_busy = 0.0
+        self._window_frames = 0
+        self._window_dropped = 0
+        self._good_windows = 0
+        self._last_change = 0.0
+
+        # The ring. Each slot is a BGR buffer frames are decoded into, and a surface wrapping the same memory.
+        # A slot is either free, ready (decoded, waiting to be shown) or showing.
+        self._buffers = [numpy.empty((height, width, 3), numpy.uint8) for _ in range(max(2, ring_size))]
+        self._surfaces = [pygame.image.frombuffer(buffer, (width, height), "BGR") for buffer in self._buffers]
+        self._slot_frames = [0] * len(self._buffers)
+        self._free = list(range(len(self._buffers)))
+        self._ready = []
+        self._showing = None
+        self._condition = threading.Condition()
+
+        # The preroll frames, decoded once when the worker starts. _parked is True while the decoder
+        # is positioned just past them.
+        self._preroll_buffers = [numpy.empty((height, width, 3), numpy.uint8) for _ in range(preroll)]
+        self._preroll_surfaces = [
+            pygame.image.frombuffer(buffer, (width, height), "BGR") for buffer in self._preroll_buffers
+        ]
+        self._preroll_count = 0
+        self._preroll_playing = False
+        self._preroll_showing = None
+        self._parked = False
+
+        self.active = False
+        self.frame = 0
+        self.dropped = 0
+        self._start_time = 0.0
+        self._next_frame = 0
+        self._ended = False
+        self._restart_requested = False
+        self._restart_from_preroll = False
+        self._restart_time = None
+        self.first_frame_latency = None
+        self._closed = False
+        self._worker = threading.Thread(target=self._decode_frames, name="video decode", daemon=True)
+        self._worker.start()
+        # pyvidplayer2 starts playing as soon as the video is loaded.
+        self.restart()
+
+    def mute(self):
+        # Frames only, there is no audio to mute.
+        pass
+
+    def play(self):
+        with self._condition:
+            if self._ended:
+                self._request_restart()
+            self.active = True
+            self._condition.notify_all()
+
+    def restart(self):
+        with self._condition:
+            self._request_restart()
+            self.active = True
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self.active = False
+            self._ended = True
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+        for source in self._sources:
+            if source is not None:
+                source.close()
+
+    # Blit the newest frame that is due. Returns True if a new frame was drawn, like pyvidplayer2.
+    def draw(self, surf, pos, force_draw=True):
+        with self._condition:
+            now = time.monotonic()
+            newest = None
+            while self._ready and self._frame_time(self._slot_frames[self._ready[0]]) <= now:
+                if newest is not None:
+                    self._free.append(newest)
+                    self.dropped += 1
+                newest = self._ready.pop(0)
+            if newest is not None:
+                if self._showing is not None:
+                    self._free.append(self._showing)
+                self._showing = newest
+                self._preroll_playing = False
+                self.frame = self._slot_frames[newest]
+                self._condition.notify_all()
+                surface = self._surfaces[newest]
+            elif self._preroll_playing:
+                # Hold the last preroll frame if the decoder hasn't caught up yet.
+                preroll_frame = min(int((now - self._start_time) * self.fps), self._preroll_count - 1)
+                if preroll_frame != self._preroll_showing:
+                    self._preroll_showing = self.frame = preroll_frame
+                    newest = preroll_frame
+                surface = self._preroll_surfaces[self._preroll_showing]
+            else:
+                if self._ended and not self._ready and not self._restart_requested:
+                    self.active = False
+                surface = None if self._showing is None else self._surfaces[self._showing]
+            if newest is not None and self._restart_time is not None:
+                self.first_frame_latency = now - self._restart_time
+                self._restart_time = None
+                print(f"Video {self.path}: first frame {self.first_frame_latency * 1000:.1f} ms after restart")
+        if surface is None or (newest is None and not force_draw):
+            return False
+        surf.blit(surface, pos)
+        return True
+
+    def _frame_time(self, frame):
+        return self._start_time + frame / self.fps
+
+    def _request_restart(self):
+        self._restart_requested = True
+        self._restart_time = time.monotonic()
+        self._ended = False
+        # Frames already decoded are from the old position.
+        self._free.extend(self._ready)
+        self._ready.clear()
+        if self._preroll_count:
+            # Play the preroll frames from now, the decoder picks up after them.
+            self._restart_from_preroll = self._preroll_playing = True
+            self._preroll_showing = None
+            self._start_time = self._restart_time
+
+    # Decode the preroll frames, leaving the decoder parked just past them.
+    def _decode_preroll(self):
+        count = 0
+        while count < len(self._preroll_buffers) and self._read(0, self._preroll_buffers[count]):
+            count += 1
+        with self._condition:
+            self._preroll_count = count
+            self._parked = True
+
+    def _park(self):
+        self._sources[self._source_index].seek(self._preroll_count)
+        self._parked = True
+
+    def _decode_frames(self):
+        if self._preroll_buffers:
+            self._decode_preroll()
+        while True:
+            with self._condition:
+                # Wait until there is something to play and a slot to decode into.
+                while not self._closed and (
+                    not self._restart_requested and (not self.active or self._ended or not self._free)
+                ):
+                    if self._ended and self._preroll_count and not self._parked:
+                        break
+                    self._condition.wait()
+                if self._closed:
+                    return
+                park = self._ended and not self._restart_requested
+                if not park:
+                    if self._restart_requested:
+                        self._restart_requested = False
+                        if self._restart_from_preroll:
+                            # restart() already started the clock.
+                            self._restart_from_preroll = False
+                            start_frame = self._preroll_count
+                        else:
+                            start_frame = 0
+                            self._start_time = time.monotonic()
+                        if not (self._parked and start_frame == self._preroll_count):
+                            self._sources[self._source_index].seek(start_frame)
+                        self._parked = False
+                        self._next_frame = start_frame
+                        if not self._free:
+                            continue
+                    slot = self._free.pop(0)
+                    frame = self._next_frame
+                    due_frame = int((time.monotonic() - self._start_time) * self.fps)
+            if park:
+                # Get ready for the next play while nothing is playing.
+                self._park()
+                continue
+
+            # Decode outside the lock.
+            decode_start = time.monotonic()
+            name, source_index, step = self._levels[self._level]
+            if source_index != self._source_index:
+                self._source(source_index).seek(frame)
+                self._source_index = source_index
+            source = self._sources[source_index]
+            decoded = True
+            skipped = 0
+            while frame < due_frame and decoded:
+                # Behind real time: skip frames without converting them.
+                decoded = source.skip()
+                frame += 1
+                skipped += 1
+            if decoded:
+                decoded = self._read(source_index, self._buffers[slot])
+            for _ in range(step - 1):
+                # At half frame rate, every other frame is skipped on purpose.
+                source.skip()
+            self._adapt(time.monotonic(), time.monotonic() - decode_start)
+
+            with self._condition:
+                self.dropped += skipped
+                if self._restart_requested:
+                    # restart() was called while decoding, this frame is from the old position.
+                    self._free.append(slot)
+                elif not decoded:
+                    self._free.append(slot)
+                    self._ended = True
+                else:
+                    self._slot_frames[slot] = frame
+                    self._ready.append(slot)
+                    self._next_frame = frame + step
+
+    def _source(self, index):
+        if self._sources[index] is None:
+            source = open_frames(self._source_paths[index], self._use_frame_store)
+            if abs(source.fps - self.fps) > 0.01:
+                print(f"{self._source_paths[index]} is not {self.fps} fps, playing it anyway")
+            if source.size != self.original_size:
+                width, height = source.size
+                self._scratch[index] = numpy.empty((height, width, 3), numpy.uint8)
+            self._sources[index] = source
+        return self._sources[index]
+
+    # Read the next frame into buffer, scaling it up to full size if it comes from a smaller source.
+    def _read(self, source_index, buffer):
+        scratch = self._scratch[source_index]
+        if scratch is None:
+            return self._sources[source_index].read(buffer)
+        if not self._sources[source_index].read(scratch):
+            return False
+        cv2.resize(scratch, self.original_size, dst=buffer, interpolation=cv2.INTER_LINEAR)
+        return True
+
+    # Decide whether to change quality level, from how busy the decoder is and how many frames are dropped.
+    def _adapt(self, now, busy):
+        self._window_busy += busy
+        self._window_frames += 1
+        if now - self._window_start < ADAPT_WINDOW:
+            return
+        step = self._levels[self._level][2]
+        load = self._window_busy / (self._window_frames * step / self.fps)
+        dropped = self.dropped - self._window_dropped
+        self._window_start, self._window_busy, self._window_frames = now, 0.0, 0
+        self._window_dropped = self.dropped
+        if load < ADAPT_UP_LOAD and not dropped:
+            self._good_windows += 1
+        else:
+            self._good_windows = 0
+        if now - self._last_change < ADAPT_COOLDOWN:
+            return
+        if (load > ADAPT_DOWN_LOAD or dropped >= ADAPT_DOWN_DROPPED) and self._level < len(self._levels) - 1:
+            self._level += 1
+        elif self._good_windows >= ADAPT_UP_WINDOWS and self._level > 0:
+            self._level -= 1
+            self._good_windows = 0
+        else:
+            return
+        self._last_change = now
+        self.quality = self._levels[self._level][0]
+        print(f"Video {self.path}: {self.quality} (decode load {load:.0%}, {dropped} frames dropped)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a frame store so a movie plays without decoding")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("movie")
+    parser.add_argument("--format", choices=sorted(FRAME_STORE_FORMATS), default="i420")
+    args = parser.parse_args()
+    build_frame_store(args.movie, args.format)
+
+
+if __name__ == "__main__":
+    main()